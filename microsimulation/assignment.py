@@ -1,8 +1,56 @@
 """ assignment.py """
 
 import os.path
+import json
+import shutil
+import copy
+import zlib
+import multiprocessing
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
+from microsimulation.pool import PersonPool
+from microsimulation.sampler import ConditionalSampler
+from microsimulation.state import AssignmentState
+from microsimulation.geography import GeogLookup
+from microsimulation.matching import CountMatcher
+import microsimulation.columnar as columnar
+from microsimulation.trace import Trace
+
+
+class ReferenceData:
+  """
+  Reference data shared (read-only) by all assignments: the geography lookup and the microdata distributions of HRPs
+  and of partners/children conditional on HRP. Load once and pass to each Assignment to avoid reloading per region
+  """
+
+  def __init__(self, input_dir="./persistent_data"):
+
+    # get OA<->MSOA mapping (compiled from gb_geog_lookup.csv.gz on first use)
+    self.geog_lookup = GeogLookup.load(input_dir + "/gb_geog_lookup")
+
+    # distributions of various people by age/sex/ethnicity from microdata
+    # see Mistral/R/microdata_dists.R
+    self.hrp_dist = {}
+    self.hrp_dist["sgl"] = pd.read_csv(input_dir + "/hrp_sgl_dist.csv") # single occupant HRPs
+    self.hrp_dist["cpl"] = pd.read_csv(input_dir + "/hrp_cpl_dist.csv") # couple HRPs
+    self.hrp_dist["sp"] = pd.read_csv(input_dir + "/hrp_sp_dist.csv") # single parent HRPs
+    self.hrp_dist["mix"] = pd.read_csv(input_dir + "/hrp_dist.csv") # all HRPs for now
+
+    self.hrp_index = {}
+    self.hrp_index["sgl"] = [1]
+    self.hrp_index["cpl"] = [2, 3]
+    self.hrp_index["sp"] = [4]
+    self.hrp_index["mix"] = [5]
+    
+    # distribution of partner age/sex/eth by HRP age/sex/eth
+    self.partner_hrp_dist = pd.read_csv(input_dir + "/partner_hrp_dist.csv")
+    # distribution of child age/sex/eth by HRP age/sex/eth
+    self.child_hrp_dist = pd.read_csv(input_dir + "/child_hrp_dist.csv")
+
+    # compile the above for sampling conditional on HRP age and eth, relaxing the constraints if no matches
+    self.partner_sampler = ConditionalSampler(self.partner_hrp_dist, [["agehrp", "ethhuk11"], ["agehrp"], []])
+    self.child_sampler = ConditionalSampler(self.child_hrp_dist, [["agehrp", "ethhuk11"], ["agehrp"], ["ethhuk11"], []])
 
 
 class Assignment:
@@ -13,12 +61,35 @@ class Assignment:
   # Treat under 18s as dependent children
   ADULT_AGE = 16
 
-  def __init__(self, region, h_resolution, p_resolution, year, variant, strictmode, data_dir):
+  # base seed for the random streams of each MSOA
+  SEED = 12345
+
+  # grouping columns of the audit counts
+  H_AUDIT = ["type", "size", "communal", "filled", "hrp"]
+  P_AUDIT = ["adult", "assigned"]
+
+  # rows per chunk when partitioning the input in streaming mode
+  CHUNK_SIZE = 100000
+
+  def __init__(self, region, h_resolution, p_resolution, year, variant, strictmode, data_dir, verbosity=1, reference=None,
+               streaming=False, output_format="csv", trace=False, engine="pool"):
 
     #Common.Base.__init__(self, region, resolution, cache_dir)
     self.region = region
     self.year = year
 
+    # timing spans, written to trace_ass_<region>_<year>.json when enabled
+    self.trace = Trace(trace)
+
+    # added to the output file names when only some MSOAs are assigned (see run)
+    self.suffix = ""
+
+    # matching of sampled characteristics to people: "pool" (exact matches then a closest-fit search per person) or
+    # "counts" (contingency tables, see CountMatcher)
+    if engine not in ["pool", "counts"]:
+      raise ValueError("invalid matching engine {}".format(engine))
+    self.engine = engine
+
     # write pop back to
     self.output_dir = data_dir
 
@@ -26,175 +97,539 @@ class Assignment:
     if region[0] == "S":
       self.scotland = True
 
-    h_file = data_dir + "/ssm_hh_" + region + "_" + h_resolution + "_" + str(year) + ".csv"
-    p_file = data_dir + "/ssm_" + region + "_" + p_resolution + "_" + variant + "_" + str(year) + ".csv"
+    self.h_file = data_dir + "/ssm_hh_" + region + "_" + h_resolution + "_" + str(year) + ".csv"
+    self.p_file = data_dir + "/ssm_" + region + "_" + p_resolution + "_" + variant + "_" + str(year) + ".csv"
 
-    if not os.path.isfile(h_file):
+    if not os.path.isfile(self.h_file):
       raise RuntimeError("household input data not found")
-    if not os.path.isfile(p_file):
+    if not os.path.isfile(self.p_file):
       raise RuntimeError("population input data not found")
 
-    self.h_data = pd.read_csv(h_file, index_col="HID")
-
-    self.p_data = pd.read_csv(p_file, index_col="PID")
-
-    # index of household in persons table
-    self.p_data["HID"] = pd.Series(-1, self.p_data.index)
-    # index of HRP(person) in household table
-    self.h_data["HRPID"] = pd.Series(-1, self.h_data.index)
-    # flag to indicate if household is complete 
-    self.h_data["FILLED"] = pd.Series(False, self.h_data.index)
+    # csv, or a columnar format (see columnar.FORMATS)
+    if output_format != "csv" and output_format not in columnar.FORMATS:
+      raise ValueError("invalid output format {}".format(output_format))
+    self.output_format = output_format
+
+    # in streaming mode the input is only loaded one MSOA at a time, in run
+    self.streaming = streaming
+    self.h_data = None
+    self.p_data = None
+    if not self.streaming:
+      with self.trace.span("load"):
+        self.h_data = pd.read_csv(self.h_file, index_col="HID")
+        self.p_data = pd.read_csv(self.p_file, index_col="PID")
+        Assignment.__init_linkage(self.p_data, self.h_data)
 
     self.strictmode = strictmode
+    # 0 to suppress per-pass progress stats
+    self.verbosity = verbosity
     if self.strictmode:
-      print("Strict assignment mode IGNORED - assignment will fail if not enough people in any category of the sample population")
+      print("Strict assignment mode - assignment will fail if not enough people in any category of the sample population")
     else:
       print("Relaxed assignment mode - assignment will sample as many people as it can in any category of the sample population")
 
-    # TODO create one lookup table then use it...
-    # get OA<->MSOA mapping
-    self.geog_lookup = pd.read_csv("./persistent_data/gb_geog_lookup.csv.gz", compression="infer").rename({"OA": "oa","LSOA": "lsoa","MSOA": "msoa", "LAD": "la"}, axis=1)
-
-    # distributions of various people by age/sex/ethnicity from microdata
-    # see Mistral/R/microdata_dists.R
-    self.hrp_dist = {}
-    self.hrp_dist["sgl"] = pd.read_csv("./persistent_data/hrp_sgl_dist.csv") # single occupant HRPs
-    self.hrp_dist["cpl"] = pd.read_csv("./persistent_data/hrp_cpl_dist.csv") # couple HRPs
-    self.hrp_dist["sp"] = pd.read_csv("./persistent_data/hrp_sp_dist.csv") # single parent HRPs
-    self.hrp_dist["mix"] = pd.read_csv("./persistent_data/hrp_dist.csv") # all HRPs for now
-
-    self.hrp_index = {}
-    self.hrp_index["sgl"] = [1]
-    self.hrp_index["cpl"] = [2, 3]
-    self.hrp_index["sp"] = [4]
-    self.hrp_index["mix"] = [5]
-    
-    # distribution of partner age/sex/eth by HRP age/sex/eth
-    self.partner_hrp_dist = pd.read_csv("./persistent_data/partner_hrp_dist.csv")
-    # distribution of child age/sex/eth by HRP age/sex/eth
-    self.child_hrp_dist = pd.read_csv("./persistent_data/child_hrp_dist.csv")
-
-    # make it deterministic
-    np.random.seed(12345)
+    # shared reference data (lookup and microdata distributions)
+    self.reference = reference if reference is not None else ReferenceData()
 
-  def run(self):
-    """
-    Run the sequence
-    """
+  @staticmethod
+  def __init_linkage(p_data, h_data):
+    # index of household in persons table
+    p_data["HID"] = pd.Series(-1, p_data.index)
+    # index of HRP(person) in household table
+    h_data["HRPID"] = pd.Series(-1, h_data.index)
+    # flag to indicate if household is complete 
+    h_data["FILLED"] = pd.Series(False, h_data.index)
 
+  def __remap_ethnicity(self, p_data, h_data):
     #eths = [eths[1]]
     #print(eths)
     # we have different eth resolution in the (micro)datasets
     if not self.scotland:
       eth_mapping = {-1:-1, 2:2, 3:3, 4:4, 5:4, 7:5, 8:5, 9:5, 10:5, 12:6, 13:6, 14:6, 15:6, 16:6, 18:7, 19:7, 20:7, 22:8, 23:8}
       # Replace finer ethnicities in population with the OA level / processed microdata values 
-      self.p_data.DC2101EW_C_ETHPUK11.replace(eth_mapping, inplace=True)
+      p_data.DC2101EW_C_ETHPUK11.replace(eth_mapping, inplace=True)
     else:
       # map to coarser ethnicity
       eth_mapping = {-1:-1, 1:1, 8:2, 9:3, 15:4, 18:5, 22:6}
-      self.p_data.DC2101EW_C_ETHPUK11.replace(eth_mapping, inplace=True)
-      # eths = self.hrp_dist["sgl"].ethhuk11.unique()
+      p_data.DC2101EW_C_ETHPUK11.replace(eth_mapping, inplace=True)
+      # eths = self.reference.hrp_dist["sgl"].ethhuk11.unique()
       # for eth in eths:
-      #   print(eth, len(self.hrp_dist["sgl"][self.hrp_dist["sgl"].ethhuk11 == eth]))
+      #   print(eth, len(self.reference.hrp_dist["sgl"][self.reference.hrp_dist["sgl"].ethhuk11 == eth]))
       # now remap to values in the microdata
       eth_remapping = {-1:-1, 1:2, 2:3, 3:4, 4:5, 5:6, 6:8}
-      self.p_data.DC2101EW_C_ETHPUK11.replace(eth_remapping, inplace=True)
-      self.h_data.LC4202_C_ETHHUK11.replace(eth_remapping, inplace=True)
-      
-  
+      p_data.DC2101EW_C_ETHPUK11.replace(eth_remapping, inplace=True)
+      h_data.LC4202_C_ETHHUK11.replace(eth_remapping, inplace=True)
+
+  def run(self, workers=1, previous=None, msoas=None):
+    """
+    Run the sequence
+    MSOAs are independent so can be assigned in parallel by a pool of worker processes. Each MSOA has its own
+    random stream so the results do not depend on the number of workers
+    In streaming mode MSOAs are assigned one at a time (workers is ignored)
+    previous is an optional (completed) assignment of the same region for an earlier year, whose linkage is reused for
+    the households and people that persist (see __carry_forward), so that only the remainder are assigned
+    msoas is an optional list of MSOAs to (re)assign on their own. As each MSOA has its own random streams the results
+    are identical to those of a full run. Only their people and households are output, with "_subset" appended to the
+    file names
+    """
+    if self.streaming and previous is not None:
+      raise ValueError("incremental assignment is not supported in streaming mode")
+    if msoas is not None:
+      self.suffix = "_subset"
+
+    with self.trace.span("run", region=self.region, year=self.year, workers=workers, streaming=self.streaming):
+      with self.trace.span("feasibility"):
+        self.__check_feasibility(msoas)
+      if self.streaming:
+        self.__run_streaming(msoas)
+      else:
+        self.__run(workers, previous, msoas)
+    self.trace.write(self.output_dir + "/trace_ass_" + self.region + "_" + str(self.year) + self.suffix + ".json")
+
+  def __check_feasibility(self, subset):
+    """
+    Pre-flight comparison of the people required by the households with the people available, per MSOA, from grouped
+    counts of the input (see demand and supply), before any sampling. Prints and writes any expected shortfalls to
+    ass_feasibility_<region>_<year>.csv. In strict mode a shortfall aborts the assignment
+    """
+    if self.streaming:
+      # read only the columns needed, in chunks
+      p_chunks = pd.read_csv(self.p_file, usecols=["Area", "DC1117EW_C_AGE"], chunksize=Assignment.CHUNK_SIZE)
+      h_chunks = pd.read_csv(self.h_file, usecols=["Area", "LC4408_C_AHTHUK11", "LC4404_C_SIZHUK11", "QS420_CELL",
+                                                   "CommunalSize"], chunksize=Assignment.CHUNK_SIZE)
+    else:
+      p_chunks = [self.p_data]
+      h_chunks = [self.h_data]
+    supply = pd.concat([Assignment.supply(chunk) for chunk in p_chunks])
+    demand = pd.concat([Assignment.demand(chunk, self.reference.geog_lookup.msoa_for_oa(chunk.Area.values.astype(str)))
+                        for chunk in h_chunks])
+
+    # households in OAs with no MSOA aren't assigned
+    demand = demand[demand.MSOA != ""]
+    table = pd.merge(demand.groupby(["MSOA", "category"])["count"].sum().rename("demand"),
+                     supply.groupby(["MSOA", "category"])["count"].sum().rename("supply"),
+                     how="outer", left_index=True, right_index=True).fillna(0).astype(int).reset_index()
+    if subset is not None:
+      table = table[table.MSOA.isin(subset)]
+    table["shortfall"] = (table.demand - table.supply).clip(lower=0)
+    shortfalls = table[table.shortfall > 0]
+
+    f_file = self.output_dir + "/ass_feasibility_" + self.region + "_" + str(self.year) + self.suffix + ".csv"
+    shortfalls.to_csv(f_file, index=False)
+    if not len(shortfalls):
+      print("feasibility check: no shortfalls")
+      return
+    print("feasibility check: expected shortfalls")
+    print(shortfalls.to_string(index=False))
+    if self.strictmode:
+      raise RuntimeError("assignment infeasible in strict mode: {} shortfall(s) in {} MSOA(s), see {}"
+                         .format(len(shortfalls), shortfalls.MSOA.nunique(), f_file))
+
+  @staticmethod
+  def demand(h_data, msoas):
+    """
+    Returns grouped counts (MSOA, category, count) of the people required by the households, msoas being the MSOA of
+    each household. Categories are adults and children (the minimum implied by each household's type and size, plus
+    communal residents) and the communal 75+ and 18-25 age bands. Counts for subsets of the households can be summed
+    """
+    h_type = h_data.LC4408_C_AHTHUK11.values
+    h_size = h_data.LC4404_C_SIZHUK11.values
+    couple = np.isin(h_type, [2, 3])
+    # single: 1 adult, couple: 2 adults + children, lone parent: 1 adult + children, multi: an adult per occupant
+    adults = np.select([h_type == 1, couple, h_type == 4, h_type == 5], [1, 2, 1, h_size], 0)
+    children = np.select([couple, h_type == 4], [h_size - 2, h_size - 1], 0).clip(min=0)
+    # communal residents are all adults, some from particular age bands (see __fill_communal)
+    ctype = h_data.QS420_CELL.values
+    nocc = np.where(ctype > -1, h_data.CommunalSize.values, 0).clip(min=0).astype(int)
+    counts = pd.DataFrame({"MSOA": msoas,
+                           "adults": adults + nocc,
+                           "children": children,
+                           "communal_75+": np.where(ctype < 22, nocc, 0),
+                           "communal_18-25": np.where((ctype >= 22) & (ctype < 27), nocc, 0)})
+    return counts.groupby("MSOA").sum().stack().rename("count").rename_axis(["MSOA", "category"]).reset_index()
+
+  @staticmethod
+  def supply(p_data):
+    """
+    Returns grouped counts (MSOA, category, count) of the people available in each of the demand categories
+    """
+    age = p_data.DC1117EW_C_AGE.values
+    counts = pd.DataFrame({"MSOA": p_data.Area.values,
+                           "adults": age > Assignment.ADULT_AGE,
+                           "children": age <= Assignment.ADULT_AGE,
+                           "communal_75+": age > 75,
+                           "communal_18-25": (age > 18) & (age < 26)})
+    return counts.groupby("MSOA").sum().stack().rename("count").rename_axis(["MSOA", "category"]).reset_index()
+
+  def __run(self, workers, previous, msoas):
+
+    if msoas is not None:
+      Assignment.__check_msoas(msoas, self.p_data.Area.unique())
+      oas = np.concatenate([self.__oas(msoa) for msoa in msoas])
+      self.p_data = self.p_data[self.p_data.Area.isin(msoas)].copy()
+      self.h_data = self.h_data[self.h_data.Area.isin(oas)].copy()
+
+    with self.trace.span("setup"):
+      self.__remap_ethnicity(self.p_data, self.h_data)
+
+      # mutable assignment state is held in arrays and written back to the tables once complete
+      self.state = AssignmentState(self.p_data, self.h_data)
+
+    if previous is not None:
+      with self.trace.span("carry_forward"):
+        self.__carry_forward(previous)
+
     self.stats()
 
     msoas = self.p_data.Area.unique()
 
+    oas = {}
     for msoa in msoas:
-      oas = self.geog_lookup[self.geog_lookup.msoa == msoa].oa.values
+      oas[msoa] = self.__oas(msoa)
 
-      if not len(oas):
-        raise ValueError("no OA11 codes found for MSOA {}, lookup table likely incomplete".format(msoa))
+    with self.trace.span("assign"):
+      if workers > 1:
+        # the workers start from the (carried forward) linkage in the tables
+        self.state.sync(self.p_data, self.h_data)
+        self.__run_parallel(msoas, oas, workers)
+      else:
+        for msoa in msoas:
+          self.assign_msoa(msoa, oas[msoa])
+        self.state.sync(self.p_data, self.h_data)
 
-      print(msoa + ":", oas)
+    with self.trace.span("check"):
+      report = self.check()
+    # write results
+    with self.trace.span("write"):
+      self.write_results(report)
 
-      # LC4408_C_AHTHUK11
-      # "1": "One person household",                                   1 adult, 0 children
-      # "2": "Married or same-sex civil partnership couple household", 2 adults, >=0 children
-      # "3": "Cohabiting couple household",                            2 adults, >=0 children
-      # "4": "Lone parent household",                                  1 adults, >0 children
-      # "5": "Multi-person household"                                  >2 adults >=0 children
+  @staticmethod
+  def __check_msoas(msoas, region_msoas):
+    unknown = set(msoas) - set(region_msoas)
+    if unknown:
+      raise ValueError("MSOA(s) {} have no people in the region".format(sorted(unknown)))
 
+  def __carry_forward(self, previous):
+    """
+    Reuses the linkage of the previous assignment for persisting households and people. There is no identity across
+    years in the input, so households persist if they have an identical record in the previous year, and people if
+    they have the same Area, sex and eth and have aged by the interval between the years (repeated records are paired
+    in order of occurrence). A household is carried forward, with its HRP and occupants, only if all of its previous
+    occupants persist. Other people (e.g. from dissolved households) are unassigned.
+    Carried forward households are treated as filled, so the structural passes (HRP, partner, child, multi and
+    communal) don't add to them. Those that weren't filled last year are reopened for the surplus passes (see reopen)
+    """
+    interval = self.year - previous.year
+    if interval <= 0:
+      raise ValueError("previous assignment ({}) must be for an earlier year than {}".format(previous.year, self.year))
+    p_prev = previous.p_data
+    h_prev = previous.h_data
+
+    # households: same record
+    h_cols = [col for col in self.h_data.columns if col not in ["HRPID", "FILLED"]]
+    h_prev_ref, h_ref = Assignment.__pair(h_prev[h_cols], self.h_data[h_cols])
+    # people: same record, aged (C_AGE 86 means 85+)
+    p_cols = [col for col in self.p_data.columns if col != "HID"]
+    p_keys = p_prev[p_cols].assign(DC1117EW_C_AGE=np.minimum(p_prev.DC1117EW_C_AGE.values + interval, 86))
+    p_prev_ref, p_ref = Assignment.__pair(p_keys, self.p_data[p_cols])
+
+    # previous household of each previous person, and current household/person of each previous household/person
+    p_prev_hid = AssignmentState.positions(p_prev.HID.values, h_prev.index)
+    h_map = np.full(len(h_prev), -1, dtype=int)
+    h_map[h_prev_ref] = h_ref
+    p_map = np.full(len(p_prev), -1, dtype=int)
+    p_map[p_prev_ref] = p_ref
+
+    # households that persist, are occupied, and whose occupants all persist
+    occupied = p_prev_hid != -1
+    occupants = np.bincount(p_prev_hid[occupied], minlength=len(h_prev))
+    persisting = np.bincount(p_prev_hid[occupied & (p_map != -1)], minlength=len(h_prev))
+    carried = (h_map != -1) & (occupants > 0) & (persisting == occupants)
+
+    p_carried = occupied & carried[np.maximum(p_prev_hid, 0)]
+    self.state.assign(p_map[p_carried], h_map[p_prev_hid[p_carried]])
+    h_prev_hrp = AssignmentState.positions(h_prev.HRPID.values, p_prev.index)
+    with_hrp = carried & (h_prev_hrp != -1)
+    self.state.set_hrp(h_map[with_hrp], p_map[h_prev_hrp[with_hrp]])
+    self.state.fill(h_map[carried])
+    self.state.reopen[h_map[carried & ~h_prev.FILLED.values.astype(bool)]] = True
+
+    print("carried forward %d of %d households and %d of %d people from %d"
+          % (np.sum(carried), len(self.h_data), np.sum(p_carried), len(self.p_data), previous.year))
+
+  @staticmethod
+  def __pair(prev_keys, keys):
+    """
+    Pairs the rows of two tables with identical keys (all columns), the nth occurrence of a key in one with the nth
+    occurrence in the other. Returns the row positions of the pairs in each table
+    """
+    cols = list(keys.columns)
+    prev_keys = prev_keys.reset_index(drop=True)
+    prev_keys = prev_keys.assign(_n=prev_keys.groupby(cols, sort=False).cumcount().values, _pos=np.arange(len(prev_keys)))
+    keys = keys.reset_index(drop=True)
+    keys = keys.assign(_n=keys.groupby(cols, sort=False).cumcount().values, _pos=np.arange(len(keys)))
+    pairs = prev_keys.merge(keys, on=cols + ["_n"], suffixes=("_prev", ""))
+    return pairs._pos_prev.values, pairs._pos.values
+
+  def __oas(self, msoa):
+    oas = self.reference.geog_lookup.oas_for_msoa(msoa)
+    if not len(oas):
+      raise ValueError("no OA11 codes found for MSOA {}, lookup table likely incomplete".format(msoa))
+    return oas
+
+  def __run_streaming(self, subset):
+    """
+    Bounded-memory assignment. The input is first partitioned on disk by MSOA (reading it in chunks), then each
+    MSOA's people and households are loaded, assigned and appended to the output in turn. The results are the same
+    as a full assignment, although the output rows are grouped by MSOA. subset optionally restricts the MSOAs
+    """
+    part_dir = self.output_dir + "/ass_parts_" + self.region + "_" + str(self.year)
+    # grouped counts for check(), summed over MSOAs
+    h_counts = []
+    p_counts = []
+    try:
+      with self.trace.span("partition"):
+        msoas = self.__partition(part_dir)
+      if subset is not None:
+        Assignment.__check_msoas(subset, msoas)
+        msoas = [msoa for msoa in msoas if msoa in subset]
+
+      for i, msoa in enumerate(msoas):
+        with self.trace.span("load", msoa=msoa):
+          self.p_data = self.__read_partition(part_dir, "p", msoa, self.p_file, "PID")
+          self.h_data = self.__read_partition(part_dir, "h", msoa, self.h_file, "HID")
+          Assignment.__init_linkage(self.p_data, self.h_data)
+          self.__remap_ethnicity(self.p_data, self.h_data)
+
+        # households in OAs with no MSOA, or in MSOAs with no people, are output unassigned (as per a full assignment)
+        if msoa and len(self.p_data):
+          self.state = AssignmentState(self.p_data, self.h_data)
+          self.assign_msoa(msoa, self.__oas(msoa))
+          self.state.sync(self.p_data, self.h_data)
+
+        h_count, p_count = Assignment.audit(self.p_data, self.h_data)
+        h_counts.append(h_count)
+        p_counts.append(p_count)
+        with self.trace.span("write", msoa=msoa):
+          self.__write_tables(self.p_data, self.h_data, append=i > 0)
+    except BaseException:
+      # don't leave partial csv output (columnar output is written whole partitions at a time)
+      if self.output_format == "csv":
+        for file in self.__table_files():
+          if os.path.isfile(file):
+            os.remove(file)
+      raise
+    finally:
+      if os.path.isdir(part_dir):
+        shutil.rmtree(part_dir)
+      self.p_data = None
+      self.h_data = None
+      self.state = None
+
+    h_counts = pd.concat(h_counts)
+    p_counts = pd.concat(p_counts)
+    with self.trace.span("check"):
+      report = self.check((h_counts.groupby(Assignment.H_AUDIT, as_index=False)["count"].sum(),
+                           p_counts.groupby(Assignment.P_AUDIT, as_index=False)["count"].sum()))
+    self.__write_report(report)
+
+  def __partition(self, part_dir):
+    """
+    Splits the people (by Area) and households (by the MSOA of their Area) into a csv file per MSOA in part_dir,
+    reading the input in chunks. Returns the MSOAs in order of appearance in the people, then the households
+    """
+    if os.path.isdir(part_dir):
+      shutil.rmtree(part_dir)
+    os.makedirs(part_dir)
+
+    msoas = {}
+    for prefix, file in [("p", self.p_file), ("h", self.h_file)]:
+      for chunk in pd.read_csv(file, chunksize=Assignment.CHUNK_SIZE):
+        if prefix == "p":
+          keys = chunk.Area.values
+        else:
+          keys = self.reference.geog_lookup.msoa_for_oa(chunk.Area.values.astype(str))
+        for msoa, rows in chunk.groupby(keys, sort=False):
+          part_file = os.path.join(part_dir, prefix + "_" + msoa + ".csv")
+          rows.to_csv(part_file, mode="a", header=not os.path.isfile(part_file), index=False)
+          msoas[msoa] = True
+    return list(msoas)
+
+  @staticmethod
+  def __read_partition(part_dir, prefix, msoa, file, index_col):
+    part_file = os.path.join(part_dir, prefix + "_" + msoa + ".csv")
+    if not os.path.isfile(part_file):
+      # no rows for this MSOA, get the columns from the input
+      return pd.read_csv(file, index_col=index_col, nrows=0)
+    return pd.read_csv(part_file, index_col=index_col)
+
+  def assign_msoa(self, msoa, oas):
+    """
+    Run the sequence of assignment passes for the people in msoa and the households in oas
+    """
+    with self.trace.span("msoa", msoa=msoa):
+      self.__assign_msoa(msoa, oas)
+
+  def __assign_msoa(self, msoa, oas):
+    print(msoa + ":", oas)
+
+    # index the unassigned people in this MSOA
+    with self.trace.span("pool"):
+      p_ref = self.state.people(msoa)
+      p_ref = p_ref[self.state.hid[p_ref] == -1]
+      self.pool = PersonPool(msoa, p_ref, self.state.p_age[p_ref], self.state.p_sex[p_ref], self.state.p_eth[p_ref])
+
+    # LC4408_C_AHTHUK11
+    # "1": "One person household",                                   1 adult, 0 children
+    # "2": "Married or same-sex civil partnership couple household", 2 adults, >=0 children
+    # "3": "Cohabiting couple household",                            2 adults, >=0 children
+    # "4": "Lone parent household",                                  1 adults, >0 children
+    # "5": "Multi-person household"                                  >2 adults >=0 children
+
+    with self.__pass(msoa, "hrp"):
       print("assigning HRPs")
       self.__sample_hrp(msoa, oas)
       self.stats()
 
-      # check all occupied households have a HRP assigned
-      if -1 in self.h_data.HRPID:
-        raise RuntimeError("HRP assignment failure")
-
+    with self.__pass(msoa, "partner"):
       print("assigning partners to HRPs where appropriate")
       self.__sample_partner(msoa, oas)
       self.stats()
 
-      # TODO check all partners assigned...
+    # TODO check all partners assigned...
 
+    with self.__pass(msoa, "single_parent_child_1"):
       print("assigning child 1 to single-parent households")
       self.__sample_single_parent_child(msoa, oas, 2, mark_filled=True)
       self.stats()
 
+    with self.__pass(msoa, "single_parent_child_2"):
       print("assigning child 2 to single-parent households")
       self.__sample_single_parent_child(msoa, oas, 3, mark_filled=True)
       self.stats()
 
+    with self.__pass(msoa, "single_parent_child_3"):
       print("assigning child 3 to single-parent households")
       self.__sample_single_parent_child(msoa, oas, 4, mark_filled=False)
       self.stats()
 
-      # TODO if partner hasnt been assigned then household may be incorrectly marked filled
+    # TODO if partner hasnt been assigned then household may be incorrectly marked filled
+    with self.__pass(msoa, "couple_child_1"):
       print("assigning child 1 to couple households")
       self.__sample_couple_child(msoa, oas, 3, mark_filled=True)
       self.stats()
 
-      # TODO if partner hasnt been assigned then household may be incorrectly marked filled
+    # TODO if partner hasnt been assigned then household may be incorrectly marked filled
+    with self.__pass(msoa, "couple_child_2"):
       print("assigning child 2 to single-parent households")
       self.__sample_couple_child(msoa, oas, 4, mark_filled=False)
       self.stats()
 
+    with self.__pass(msoa, "multi"):
       print("multi-person households")
       self.__fill_multi(msoa, oas, 2)
       self.__fill_multi(msoa, oas, 3)
       self.__fill_multi(msoa, oas, 4, mark_filled=False)
       self.stats()
 
+    with self.__pass(msoa, "communal"):
       print("assigning people to communal establishments")
       self.__fill_communal(msoa, oas)
       self.stats()
 
+    # carried forward households that were open last year can take surplus people
+    h_ref = self.state.households(oas)
+    self.state.unfill(h_ref[self.state.reopen[h_ref]])
+
+    with self.__pass(msoa, "surplus_adults"):
       print("assigning surplus adults")
       self.__assign_surplus_adults(msoa, oas)
       self.stats()
 
+    with self.__pass(msoa, "surplus_children"):
       print("assigning surplus children")
       self.__assign_surplus_children(msoa, oas)
       self.stats()
 
-    self.check()
-    # write results
-    self.write_results()
+  @contextmanager
+  def __pass(self, msoa, name):
+    """
+    Sets up (and times) an assignment pass for msoa. Each pass has its own random stream, derived from the base seed,
+    the MSOA code and the pass name, so its draws don't depend on any other MSOA or pass
+    """
+    self.rng = np.random.default_rng([Assignment.SEED, zlib.crc32(msoa.encode()), zlib.crc32(name.encode())])
+    with self.trace.span(name):
+      yield
+
+  def __run_parallel(self, msoas, oas, workers):
+    """
+    Splits the people and households by MSOA, assigns in a process pool and merges the results
+    """
+    print("assigning %d MSOAs using %d processes" % (len(msoas), workers))
+
+    def tasks():
+      for msoa in msoas:
+        h_ref = self.state.households(oas[msoa])
+        yield (msoa, oas[msoa], self.p_data.iloc[self.state.people(msoa)], self.h_data.iloc[h_ref], self.state.reopen[h_ref])
+
+    # workers get a copy of everything except the population and household tables
+    template = copy.copy(self)
+    template.p_data = None
+    template.h_data = None
+    template.state = None
+    template.trace = Trace(self.trace.enabled)
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(template,)) as pool:
+      for p_hid, h_state, spans in pool.imap(_assign_msoa, tasks()):
+        self.trace.add(spans)
+        self.p_data.loc[p_hid.index, "HID"] = p_hid.values
+        self.h_data.loc[h_state.index, "HRPID"] = h_state.HRPID.values
+        self.h_data.loc[h_state.index, "FILLED"] = h_state.FILLED.values
+
+  def write_results(self, report=None):
+    self.__write_tables(self.p_data, self.h_data)
+    if report is not None:
+      self.__write_report(report)
+
+  def __write_tables(self, p_data, h_data, append=False):
+    if self.output_format != "csv":
+      # datasets partitioned by MSOA and year (so appending is just writing more partitions)
+      h_msoas = self.reference.geog_lookup.msoa_for_oa(h_data.Area.values.astype(str))
+      columnar.write(h_data, self.output_dir + "/ass_hh_" + self.region + "_OA11" + self.suffix, h_msoas, self.year,
+                     self.output_format)
+      columnar.write(p_data, self.output_dir + "/ass_" + self.region + "_MSOA11" + self.suffix, p_data.Area.values,
+                     self.year, self.output_format)
+      return
+    h_file, p_file = self.__table_files()
+    mode = "a" if append else "w"
+    h_data.to_csv(h_file, mode=mode, header=not append)
+    p_data.to_csv(p_file, mode=mode, header=not append)
+
+  def __table_files(self):
+    """
+    Returns the household and people output files (csv format)
+    """
+    return (self.output_dir + "/ass_hh_" + self.region + "_OA11_" + str(self.year) + self.suffix + ".csv",
+            self.output_dir + "/ass_" + self.region + "_MSOA11_" + str(self.year) + self.suffix + ".csv")
 
-  def write_results(self):
-    h_file = self.output_dir + "/ass_hh_" + self.region + "_OA11_" + str(self.year) + ".csv"
-    p_file = self.output_dir + "/ass_" + self.region + "_MSOA11_" + str(self.year) + ".csv"
-    self.h_data.to_csv(h_file)
-    self.p_data.to_csv(p_file)
+  def __write_report(self, report):
+    # check() report, for comparing fill rates across regions/runs
+    r_file = self.output_dir + "/ass_check_" + self.region + "_" + str(self.year) + self.suffix + ".json"
+    with open(r_file, "w") as f:
+      json.dump(report, f, indent=2)
 
   def __sample_hrp(self, msoa, oas):
 
-    for hh_type in self.hrp_dist.keys():
-      print(hh_type, self.hrp_index[hh_type])
+    for hh_type in self.reference.hrp_dist.keys():
+      print(hh_type, self.reference.hrp_index[hh_type])
 
       # get all the occupied households with the same eth in the area 
-      h_ref = self.h_data.loc[(self.h_data.Area.isin(oas))
-                            & (self.h_data.LC4408_C_AHTHUK11.isin(self.hrp_index[hh_type]))
-                            # & (self.h_data.LC4202_C_ETHHUK11 == eth)
-                            & (self.h_data.HRPID == -1)].index
+      h_ref = self.state.households(oas)
+      h_ref = h_ref[np.isin(self.state.h_type[h_ref], self.reference.hrp_index[hh_type])
+                    # & (self.state.h_eth[h_ref] == eth)
+                    & (self.state.hrp[h_ref] == -1)
+                    # carried forward households (without an HRP) are closed
+                    & ~self.state.filled[h_ref]]
 
       n_hh = len(h_ref)
 
@@ -202,267 +637,185 @@ class Assignment:
         continue
 
       # sample from microdata distribution of HRPs for this eth
-      # hrp_eth_dist = self.hrp_dist[hh_type].loc[self.hrp_dist[hh_type].ethhuk11 == eth]
-      hrp_sample = self.hrp_dist[hh_type].sample(n_hh, weights=self.hrp_dist[hh_type].n, replace=True).index
+      # hrp_eth_dist = self.reference.hrp_dist[hh_type].loc[self.reference.hrp_dist[hh_type].ethhuk11 == eth]
+      hrp_sample = self.reference.hrp_dist[hh_type].sample(n_hh, weights=self.reference.hrp_dist[hh_type].n, replace=True,
+                                                           random_state=self.rng)
+      ages = hrp_sample.age.values
+      sexes = hrp_sample.sex.values
+      eths = hrp_sample.ethhuk11.values
 
       # now assign HRPs from the population with the sampled age/sex/eth characteristics
-      h_index = 0
-      for sample_idx in hrp_sample:
-
-        #print("sample_idx",sample_idx)
-        age = self.hrp_dist[hh_type].loc[sample_idx, "age"]
-        sex = self.hrp_dist[hh_type].loc[sample_idx, "sex"]
-        eth = self.hrp_dist[hh_type].loc[sample_idx, "ethhuk11"]
-
-        p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                              & (self.p_data.DC1117EW_C_AGE == age)
-                              & (self.p_data.DC1117EW_C_SEX == sex) 
-                              & (self.p_data.DC2101EW_C_ETHPUK11 == eth)
-                              & (self.p_data.HID == -1)].index
-        #print(sample_idx, age, sex, eth, ":", len(p_ref))
-
-        # get closest fit if no exact
-        if len(p_ref) == 0:
-          p_ref = self.get_closest_adult(msoa, age, sex, eth)
-      
-        if len(p_ref) == 0:
-          print("HRP not found:", age, sex, eth) #, hrp_eth_dist[sample_idx])
-        else: # just take first available person
-          if p_ref[0] == -1:
-            raise RuntimeError("invalid p_ref")
-          self.p_data.loc[p_ref[0], "HID"] = h_ref[h_index]
-          self.h_data.loc[h_ref[h_index], "HRPID"] = p_ref[0]
-          # mark household filled if single person
-          if self.h_data.loc[h_ref[h_index], "LC4408_C_AHTHUK11"] == 1:
-            self.h_data.loc[h_ref[h_index], "FILLED"] = True
-        h_index += 1
+      p_ref = self.__match(msoa, ages, sexes, eths, self.get_closest_adult)
+      for h_index in np.flatnonzero(p_ref == -1):
+        print("HRP not found:", ages[h_index], sexes[h_index], eths[h_index]) #, hrp_eth_dist[sample_idx])
+
+      found = p_ref != -1
+      h_found = h_ref[found]
+      p_found = p_ref[found]
+      self.state.assign(p_found, h_found)
+      self.state.set_hrp(h_found, p_found)
+      # mark household filled if single person
+      self.state.fill(h_found[self.state.h_type[h_found] == 1])
+
+  def __match(self, msoa, ages, sexes, eths, get_closest):
+    """
+    Finds (and removes from the pool) a person for each of the given characteristics. Exact matches are taken in
+    bulk, one pool lookup per (age, sex, eth) cell, the remainder get the closest fit (or, for the counts engine,
+    the equivalent relaxations are applied to count tables).
+    Returns person positions, -1 where not found
+    """
+    if self.engine == "counts":
+      if get_closest == self.get_closest_adult:
+        matcher = CountMatcher(self.pool, min_age=Assignment.ADULT_AGE + 1)
+      else:
+        matcher = CountMatcher(self.pool, max_age=Assignment.ADULT_AGE, relax_sex=False)
+      return matcher.match(ages, sexes, eths)
+
+    p_ids = np.full(len(ages), -1, dtype=int)
+
+    cells = pd.DataFrame({"age": ages, "sex": sexes, "eth": eths}).groupby(["age", "sex", "eth"], sort=False).indices
+    for (age, sex, eth), pos in cells.items():
+      matched = self.pool.take_n(age, sex, eth, len(pos))
+      p_ids[pos[:len(matched)]] = matched
+
+    # get closest fit if no exact
+    for i in np.flatnonzero(p_ids == -1):
+      p_ref = get_closest(msoa, ages[i], sexes[i], eths[i])
+      if len(p_ref):
+        self.pool.remove(p_ref)
+        p_ids[i] = p_ref[0]
+
+    return p_ids
+
+  def __get_hrps(self, h_ref):
+    """
+    Returns the households that have a HRP assigned, and their HRPs' age, sex and eth
+    """
+    hrps = self.state.hrp[h_ref]
+    # TODO fix this bug...HRP should never be -1?
+    for idx in self.state.h_ids[h_ref[hrps == -1]]:
+      print("HRPID -1 at h_data index", idx)
+    h_ref = h_ref[hrps != -1]
+    hrps = hrps[hrps != -1]
+    return h_ref, self.state.p_age[hrps], self.state.p_sex[hrps], self.state.p_eth[hrps]
 
   # TODO generalise, or be explicit about what its matching closest to
   def get_closest_adult(self, msoa, age, sex, eth):
+    # (unassigned people in msoa are held in self.pool)
     # find closest adult of same gender/eth
-    p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                          & (self.p_data.DC1117EW_C_AGE > Assignment.ADULT_AGE)
-                          & (self.p_data.DC1117EW_C_SEX == sex) 
-                          & (self.p_data.DC2101EW_C_ETHPUK11 == eth)
-                          & (self.p_data.HID == -1)].index
+    p_ref = self.pool.nearest(age, sex, eth, min_age=Assignment.ADULT_AGE + 1)
 
     # if no unassigned people, relax the eth constraint
     if len(p_ref) == 0:
-      p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                            & (self.p_data.DC1117EW_C_AGE > Assignment.ADULT_AGE)
-                            & (self.p_data.DC1117EW_C_SEX == sex) 
-                            & (self.p_data.HID == -1)].index
-      
+      p_ref = self.pool.nearest(age, sex, min_age=Assignment.ADULT_AGE + 1)
+
     # if STILL no unassigned people, relax the sex constraint
     # TODO I suspect we undercount same-sex couples - microdata suggests 0.3% which seems rather low
     if len(p_ref) == 0:
-      p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                            & (self.p_data.DC1117EW_C_AGE > Assignment.ADULT_AGE)
-                            & (self.p_data.HID == -1)].index
-      
-    # if still no unassigned people, give up
-    if len(p_ref) == 0:
-      return []
-
-    diffs = abs(self.p_data.loc[p_ref].DC1117EW_C_AGE - age)
+      p_ref = self.pool.nearest(age, min_age=Assignment.ADULT_AGE + 1)
 
-    # return as array
-    return [diffs.idxmin()]
+    # if still no unassigned people, give up (returns empty)
+    return p_ref
 
   # TODO refactor with above
   def get_closest_child(self, msoa, age, sex, eth):
-    # find closest adult of same gender/eth
-    p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                          & (self.p_data.DC1117EW_C_AGE <= Assignment.ADULT_AGE)
-                          & (self.p_data.DC1117EW_C_SEX == sex) 
-                          & (self.p_data.DC2101EW_C_ETHPUK11 == eth)
-                          & (self.p_data.HID == -1)].index
+    # find closest child of same gender/eth
+    p_ref = self.pool.nearest(age, sex, eth, max_age=Assignment.ADULT_AGE)
 
     # if no unassigned children, relax the eth constraint
     if len(p_ref) == 0:
-      p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                            & (self.p_data.DC1117EW_C_AGE <= Assignment.ADULT_AGE)
-                            & (self.p_data.DC1117EW_C_SEX == sex) 
-                            & (self.p_data.HID == -1)].index
-
-    if len(p_ref) == 0:
-      return []
-    diffs = abs(self.p_data.loc[p_ref].DC1117EW_C_AGE - age)
+      p_ref = self.pool.nearest(age, sex, max_age=Assignment.ADULT_AGE)
 
-    # return as array
-    return [diffs.idxmin()]
+    return p_ref
 
   def __sample_partner(self, msoa, oas):
 
     # get all couple households in area
-    h2_ref = self.h_data.loc[(self.h_data.Area.isin(oas))
-                           & (self.h_data.LC4408_C_AHTHUK11.isin([2, 3]))
-                           & (self.h_data.FILLED == False)].index
-
-    # loop over households
-    for idx in h2_ref:
-      # get HRP
-      hrpid = self.h_data.loc[idx, "HRPID"]
-
-      hrp_age = self.p_data.loc[hrpid, "DC1117EW_C_AGE"]
-      hrp_sex = self.p_data.loc[hrpid, "DC1117EW_C_SEX"]
-      hrp_eth = self.p_data.loc[hrpid, "DC2101EW_C_ETHPUK11"]
-      #print(hrp_age, hrp_sex, hrp_eth)
-      # sample partner dist for HRP age and ethnicity
-      dist = self.partner_hrp_dist.loc[(self.partner_hrp_dist.agehrp == hrp_age)
-                                     & (self.partner_hrp_dist.ethhuk11 == hrp_eth)]
-
-      # TODO may need to ensure nonempty
-      if len(dist) == 0:
-        print("partner-HRP not sampled:", idx, hrp_age, hrp_sex, hrp_eth, "resampling without eth constraint")
-        dist = self.partner_hrp_dist.loc[self.partner_hrp_dist.agehrp == hrp_age]
-        if len(dist) == 0:
-          print("partner-HRP not sampled:", idx, hrp_age, hrp_sex, hrp_eth, "resampling without age/eth constraints")
-          dist = self.partner_hrp_dist
-
-      partner_sample = dist.sample(1, weights=dist.n).index.values[0]
-
-      age = self.partner_hrp_dist.loc[partner_sample, "age"]
-      if self.partner_hrp_dist.loc[partner_sample, "samesex"] == True:
-        sex = hrp_sex
-      else:
-        sex = 3 - hrp_sex
-      eth = self.partner_hrp_dist.loc[partner_sample, "ethnicityew"]
-      #print(hrp_age, hrp_sex, hrp_eth, "->", age, sex, eth)
-
-      # now find a partner in the population with these characteristics
-      p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                            & (self.p_data.DC1117EW_C_AGE == age)
-                            & (self.p_data.DC1117EW_C_SEX == sex) 
-                            & (self.p_data.DC2101EW_C_ETHPUK11 == eth)
-                            & (self.p_data.HID == -1)].index
-
-      # get closest fit if no exact
-      if len(p_ref) == 0:
-        p_ref = self.get_closest_adult(msoa, age, sex, eth)
-     
-      if len(p_ref) == 0:
-        print("partner not found:", age, sex, eth) #, hrp_eth_dist[sample_idx])
-      else: # just take first available person
-        self.p_data.loc[p_ref[0], "HID"] = idx
-        # mark as filled if 2 occupants
-        if self.h_data.loc[idx, "LC4404_C_SIZHUK11"] == 2:
-          self.h_data.loc[idx, "FILLED"] = True
-
+    h2_ref = self.state.households(oas)
+    h2_ref = h2_ref[np.isin(self.state.h_type[h2_ref], [2, 3]) & ~self.state.filled[h2_ref]]
+
+    h2_ref, hrp_age, hrp_sex, hrp_eth = self.__get_hrps(h2_ref)
+
+    # sample partner dist for HRP age and ethnicity
+    partner_sample, levels = self.reference.partner_sampler.sample(np.column_stack((hrp_age, hrp_eth)), rng=self.rng)
+    for i in np.flatnonzero(levels == 1):
+      print("partner-HRP not sampled:", self.state.h_ids[h2_ref[i]], hrp_age[i], hrp_sex[i], hrp_eth[i], "resampling without eth constraint")
+    for i in np.flatnonzero(levels == 2):
+      print("partner-HRP not sampled:", self.state.h_ids[h2_ref[i]], hrp_age[i], hrp_sex[i], hrp_eth[i], "resampling without age/eth constraints")
+
+    age = self.reference.partner_hrp_dist.age.values[partner_sample]
+    sex = np.where(self.reference.partner_hrp_dist.samesex.values[partner_sample] == True, hrp_sex, 3 - hrp_sex)
+    eth = self.reference.partner_hrp_dist.ethnicityew.values[partner_sample]
+
+    # now find partners in the population with these characteristics
+    p_ref = self.__match(msoa, age, sex, eth, self.get_closest_adult)
+    for i in np.flatnonzero(p_ref == -1):
+      print("partner not found:", age[i], sex[i], eth[i])
+
+    found = p_ref != -1
+    h_found = h2_ref[found]
+    self.state.assign(p_ref[found], h_found)
+    # mark as filled if 2 occupants
+    self.state.fill(h_found[self.state.h_size[h_found] == 2])
+
+  def __sample_child(self, msoa, hsp_ref, mark_filled, max_level=None):
+    """
+    Samples a child for each household in hsp_ref conditional on the HRP's age and eth
+    """
+    hsp_ref, hrp_age, hrp_sex, hrp_eth = self.__get_hrps(hsp_ref)
+
+    # sample child dist for HRP age and ethnicity
+    child_sample, levels = self.reference.child_sampler.sample(np.column_stack((hrp_age, hrp_eth)), max_level, self.rng)
+    if max_level == 0:
+      for i in np.flatnonzero(levels == -1):
+        print("child-HRP not sampled:", self.state.h_ids[hsp_ref[i]], hrp_age[i], hrp_sex[i], hrp_eth[i])
+    for i in np.flatnonzero(levels == 1):
+      print("child-HRP not sampled:", self.state.h_ids[hsp_ref[i]], hrp_age[i], hrp_sex[i], hrp_eth[i], "resampling without eth constraint")
+    for i in np.flatnonzero(levels == 2):
+      print("child-HRP *still* not sampled:", self.state.h_ids[hsp_ref[i]], hrp_age[i], hrp_sex[i], hrp_eth[i], "resampling with eth but without age constraint")
+    for i in np.flatnonzero(levels == 3):
+      print("child-HRP *STILL* not sampled:", self.state.h_ids[hsp_ref[i]], hrp_age[i], hrp_sex[i], hrp_eth[i], "resampling without eth or age constraint")
+
+    sampled = levels != -1
+    hsp_ref = hsp_ref[sampled]
+    child_sample = child_sample[sampled]
+
+    age = self.reference.child_hrp_dist.age.values[child_sample]
+    sex = self.reference.child_hrp_dist.sex.values[child_sample]
+    eth = self.reference.child_hrp_dist.ethnicityew.values[child_sample]
+
+    # now find children in the population with these characteristics
+    # TODO differentiate between adult/child get closest fit if no exact
+    p_ref = self.__match(msoa, age, sex, eth, self.get_closest_child)
+    for i in np.flatnonzero(p_ref == -1):
+      print("child not found:", age[i], sex[i], eth[i])
+
+    found = p_ref != -1
+    self.state.assign(p_ref[found], hsp_ref[found])
+    # mark as filled
+    if mark_filled:
+      self.state.fill(hsp_ref[found])
 
   def __sample_single_parent_child(self, msoa, oas, nocc, mark_filled=True):
 
     # pool of single-parent households with nocc occupants 
-    hsp_ref = self.h_data.loc[(self.h_data.Area.isin(oas)) 
-                            & (self.h_data.LC4404_C_SIZHUK11 == nocc)
-                            & (self.h_data.LC4408_C_AHTHUK11 == 4)
-                            & (self.h_data.FILLED == False)].index
-
-    for idx in hsp_ref:
-      # get HRP
-      hrpid = self.h_data.loc[idx, "HRPID"]
-      # TODO fix this bug...HRP should never be -1?
-      if hrpid == -1:
-        print("HRPID -1 at h_data index", idx)
-        self.write_results()
-
-      hrp_age = self.p_data.loc[hrpid, "DC1117EW_C_AGE"]
-      hrp_sex = self.p_data.loc[hrpid, "DC1117EW_C_SEX"]
-      hrp_eth = self.p_data.loc[hrpid, "DC2101EW_C_ETHPUK11"]
-      # print(hrp_age, hrp_sex, hrp_eth)
-      # sample child dist for HRP age and ethnicity
-      dist = self.child_hrp_dist.loc[(self.child_hrp_dist.agehrp == hrp_age)
-                                     & (self.child_hrp_dist.ethhuk11 == hrp_eth)]
-
-      # TODO may need to ensure nonempty
-      if len(dist) == 0:
-        print("child-HRP not sampled:", idx, hrp_age, hrp_sex, hrp_eth, "resampling without eth constraint")
-        dist = self.child_hrp_dist.loc[self.child_hrp_dist.agehrp == hrp_age]
-        if len(dist) == 0:
-          print("child-HRP *still* not sampled:", idx, hrp_age, hrp_sex, hrp_eth, "resampling with eth but without age constraint")
-          dist = self.child_hrp_dist.loc[self.child_hrp_dist.ethhuk11 == hrp_eth]
-          if len(dist) == 0:
-            print("child-HRP *STILL* not sampled:", idx, hrp_age, hrp_sex, hrp_eth, "resampling without eth or age constraint")
-            dist = self.child_hrp_dist
-
-      child_sample = dist.sample(1, weights=dist.n).index.values[0]
-
-      age = self.child_hrp_dist.loc[child_sample, "age"]
-      sex = self.child_hrp_dist.loc[child_sample, "sex"]
-      eth = self.child_hrp_dist.loc[child_sample, "ethnicityew"]
-      #print(hrp_age, hrp_sex, hrp_eth, "->", age, sex, eth)
-
-      # now find a child in the population with these characteristics
-      p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                            & (self.p_data.DC1117EW_C_AGE == age)
-                            & (self.p_data.DC1117EW_C_SEX == sex) 
-                            & (self.p_data.DC2101EW_C_ETHPUK11 == eth)
-                            & (self.p_data.HID == -1)].index
-
-      # TODO differentiate between adult/child get closest fit if no exact
-      if len(p_ref) == 0:
-        p_ref = self.get_closest_child(msoa, age, sex, eth)
-     
-      if len(p_ref) == 0:
-        print("child not found:", age, sex, eth) #, hrp_eth_dist[sample_idx])
-      else: # just take first available person
-        self.p_data.loc[p_ref[0], "HID"] = idx
-        # mark as filled 
-        if mark_filled:
-          self.h_data.loc[idx, "FILLED"] = True
+    hsp_ref = self.state.households(oas)
+    hsp_ref = hsp_ref[(self.state.h_size[hsp_ref] == nocc)
+                      & (self.state.h_type[hsp_ref] == 4)
+                      & ~self.state.filled[hsp_ref]]
+
+    self.__sample_child(msoa, hsp_ref, mark_filled)
 
   def __sample_couple_child(self, msoa, oas, nocc, mark_filled=True):
 
     # pool of couple households with nocc occupants 
-    hsp_ref = self.h_data.loc[(self.h_data.Area.isin(oas)) 
-                            & (self.h_data.LC4404_C_SIZHUK11 == nocc)
-                            & (self.h_data.LC4408_C_AHTHUK11.isin([2,3]))
-                            & (self.h_data.FILLED == False)].index
-
-    for idx in hsp_ref:
-      # get HRP
-      hrpid = self.h_data.loc[idx, "HRPID"]
-      if hrpid == -1:
-        print("HRPID -1 at h_data index", idx)
-        self.write_results()
-
-      hrp_age = self.p_data.loc[hrpid, "DC1117EW_C_AGE"]
-      hrp_sex = self.p_data.loc[hrpid, "DC1117EW_C_SEX"]
-      hrp_eth = self.p_data.loc[hrpid, "DC2101EW_C_ETHPUK11"]
-      # print(hrp_age, hrp_sex, hrp_eth)
-      # sample child dist for HRP age and ethnicity
-      dist = self.child_hrp_dist.loc[(self.child_hrp_dist.agehrp == hrp_age)
-                                     & (self.child_hrp_dist.ethhuk11 == hrp_eth)]
-
-      # TODO may need to ensure nonempty
-      if len(dist) == 0:
-        print("child-HRP not sampled:", idx, hrp_age, hrp_sex, hrp_eth)
-        continue
-      child_sample = dist.sample(1, weights=dist.n).index.values[0]
-
-      age = self.child_hrp_dist.loc[child_sample, "age"]
-      sex = self.child_hrp_dist.loc[child_sample, "sex"]
-      eth = self.child_hrp_dist.loc[child_sample, "ethnicityew"]
-      #print(hrp_age, hrp_sex, hrp_eth, "->", age, sex, eth)
-
-      # now find a child in the population with these characteristics
-      p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                            & (self.p_data.DC1117EW_C_AGE == age)
-                            & (self.p_data.DC1117EW_C_SEX == sex) 
-                            & (self.p_data.DC2101EW_C_ETHPUK11 == eth)
-                            & (self.p_data.HID == -1)].index
-
-      # TODO differentiate between adult/child get closest fit if no exact
-      if len(p_ref) == 0:
-        p_ref = self.get_closest_child(msoa, age, sex, eth)
-     
-      if len(p_ref) == 0:
-        print("child not found:", age, sex, eth) #, hrp_eth_dist[sample_idx])
-      else: # just take first available person
-        self.p_data.loc[p_ref[0], "HID"] = idx
-        # mark as filled 
-        if mark_filled:
-          self.h_data.loc[idx, "FILLED"] = True
+    hsp_ref = self.state.households(oas)
+    hsp_ref = hsp_ref[(self.state.h_size[hsp_ref] == nocc)
+                      & np.isin(self.state.h_type[hsp_ref], [2, 3])
+                      & ~self.state.filled[hsp_ref]]
+
+    # no relaxation of HRP age/eth here: households with no matching child dist are skipped
+    self.__sample_child(msoa, hsp_ref, mark_filled, max_level=0)
 
 
 # Selected household ethnicities
@@ -523,14 +876,12 @@ class Assignment:
 
   def __fill_multi(self, msoa, oas, occupant, mark_filled=True):
 
-    h_ref = self.h_data.loc[(self.h_data.Area.isin(oas))
-                         #& (self.h_data.LC4408_C_SIZHUK >= occupant)
-                         & (self.h_data.LC4408_C_AHTHUK11 == 5)
-                         & (self.h_data.FILLED == False)].index
+    h_ref = self.state.households(oas)
+    h_ref = h_ref[#(self.state.h_size[h_ref] >= occupant) &
+                  (self.state.h_type[h_ref] == 5)
+                  & ~self.state.filled[h_ref]]
 
-    p_ref = self.p_data.loc[(self.p_data.Area == msoa)
-                          & (self.p_data.DC1117EW_C_AGE > Assignment.ADULT_AGE) # 18 actually means 17, so this IS 18 or over
-                          & (self.p_data.HID == -1)].index
+    p_ref = self.pool.unassigned(self.pool.age > Assignment.ADULT_AGE) # 18 actually means 17, so this IS 18 or over
 
     n_hh = len(h_ref)
     if len(p_ref) < n_hh:
@@ -541,46 +892,69 @@ class Assignment:
       return
 
     # mark people as assigned
-    p_sample = np.random.choice(p_ref, n_hh, replace=False)
-    self.p_data.loc[p_sample, "HID"] = h_ref[0:n_hh]
+    p_sample = self.rng.choice(p_ref, n_hh, replace=False)
+    self.state.assign(p_sample, h_ref[0:n_hh])
+    self.pool.remove(p_sample)
     print("assigned", n_hh, "multi-person", occupant)
 
     # mark households as filled if appropriate
     if mark_filled:
-      hf_ref = self.h_data[(self.h_data.Area.isin(oas)) & (self.h_data.LC4408_C_AHTHUK11 == 5) & (self.h_data.LC4404_C_SIZHUK11 == occupant)].index
-      self.h_data.loc[hf_ref, "FILLED"] = True
+      hf_ref = self.state.households(oas)
+      hf_ref = hf_ref[(self.state.h_type[hf_ref] == 5) & (self.state.h_size[hf_ref] == occupant)]
+      self.state.fill(hf_ref)
 
   # TODO use microdata rather than rough assumptions about age dist
   def __fill_communal(self, msoa, oas):
 
-    # to ensure we dont inadvertently modify a copy rather than the original data just use index
-    c_ref = self.h_data.loc[(self.h_data.Area.isin(oas)) & (self.h_data.QS420_CELL > -1)].index
-
-    # remember C_AGE=1 means 0
-    for index in c_ref:
-      ctype = self.h_data.loc[index, "QS420_CELL"]
-      if ctype < 22:
-        p_ref = self.p_data.loc[(self.p_data.Area == msoa) & (self.p_data.HID < 0) & (self.p_data.DC1117EW_C_AGE > 75)].index
-      elif ctype < 27:
-        p_ref = self.p_data.loc[(self.p_data.Area == msoa) & (self.p_data.HID < 0) & (self.p_data.DC1117EW_C_AGE > 18) & (self.p_data.DC1117EW_C_AGE < 26)].index
-      else:
-        p_ref = self.p_data.loc[(self.p_data.Area == msoa) & (self.p_data.HID < 0) & (self.p_data.DC1117EW_C_AGE > 16)].index
+    c_ref = self.state.households(oas)
+    c_ref = c_ref[(self.state.h_ctype[c_ref] > -1) & ~self.state.filled[c_ref]]
+    if not len(c_ref):
+      return
 
-      nocc = int(self.h_data.loc[index, "CommunalSize"])
+    # No of occupants can be zero, if so just mark as filled
+    nocc = self.state.h_csize[c_ref].astype(int)
+    self.state.fill(c_ref[nocc <= 0])
 
-      #print("Communal", index, ":", ctype, nocc, "from", len(p_ref))
+    c_ref = c_ref[nocc > 0]
+    nocc = nocc[nocc > 0]
+    if not len(c_ref):
+      return
 
-      # No of occupants can be zero, if so just mark as filled and move on
-      if nocc > 0:
-        if len(p_ref) < nocc:
+    # remember C_AGE=1 means 0
+    # the age band each establishment takes occupants from: 75+, 18-25 or 16+
+    age = self.pool.age
+    eligible = [age > 75, (age > 18) & (age < 26), age > 16]
+    ctype = self.state.h_ctype[c_ref]
+    band = np.where(ctype < 22, 0, np.where(ctype < 27, 1, 2))
+    # establishments are filled in table order (which, as the 16+ band overlaps the others, determines those left
+    # unfilled), each run of consecutive establishments in the same band at once
+    starts = np.flatnonzero(np.diff(band, prepend=-1))
+    for start, end in zip(starts, np.append(starts[1:], len(band))):
+      p_ref = self.pool.unassigned(eligible[band[start]])
+      b_ref = c_ref[start:end]
+      b_nocc = nocc[start:end]
+
+      # establishments are filled in table order while there are enough people left, skipping any that are too big
+      accepted = np.zeros(len(b_ref), dtype=bool)
+      available = len(p_ref)
+      for i, n in enumerate(b_nocc):
+        if n > available:
           print("cannot assign to communal")
-          continue 
-        # randomly pick occupants
-        p_sample = np.random.choice(p_ref, nocc, replace=False)
-        # assing a dwelling ref to people
-        self.p_data.loc[p_sample, "HID"] = index
-      # mark the communal residence as filled
-      self.h_data.loc[index, "FILLED"] = True
+          continue
+        accepted[i] = True
+        available -= n
+      if not np.any(accepted):
+        continue
+      b_ref = b_ref[accepted]
+      b_nocc = b_nocc[accepted]
+
+      # randomly pick the occupants of all the run's establishments at once
+      p_sample = self.rng.choice(p_ref, b_nocc.sum(), replace=False)
+      # assign a dwelling ref to people
+      self.state.assign(p_sample, np.repeat(b_ref, b_nocc))
+      self.pool.remove(p_sample)
+      # mark the communal residences as filled
+      self.state.fill(b_ref)
 
   def __assign_surplus_adults(self, msoa, oas):
     # assign remaining adults after minimal assignment to:
@@ -589,15 +963,17 @@ class Assignment:
     # or, in fact, empty households
     # TODO by ethnicity
 
-    p_unassigned = self.p_data.loc[(self.p_data.Area == msoa) & (self.p_data.DC1117EW_C_AGE > Assignment.ADULT_AGE) & (self.p_data.HID == -1)].index
+    p_unassigned = self.pool.unassigned(self.pool.age > Assignment.ADULT_AGE)
 
     n_p = len(p_unassigned)
 
-    h_candidates = self.h_data.loc[(self.h_data.Area.isin(oas)) & (self.h_data.LC4408_C_AHTHUK11 == 5) & (self.h_data.FILLED == False)].index
+    h_candidates = self.state.households(oas)
+    h_candidates = h_candidates[(self.state.h_type[h_candidates] == 5) & ~self.state.filled[h_candidates]]
     if len(h_candidates) > 0:
-      h_sample = np.random.choice(h_candidates, n_p, replace=True)
+      h_sample = self.rng.choice(h_candidates, n_p, replace=True)
 
-      self.p_data.loc[p_unassigned, "HID"] = h_sample
+      self.state.assign(p_unassigned, h_sample)
+      self.pool.remove(p_unassigned)
 
 
   def __assign_surplus_children(self, msoa, oas):
@@ -606,77 +982,127 @@ class Assignment:
 
     for eth in [2, 3, 4, 5, 6, 7,8]:
 
-      c_unassigned = self.p_data.loc[(self.p_data.Area == msoa) 
-                                   & (self.p_data.DC2101EW_C_ETHPUK11 == eth)
-                                   & (self.p_data.DC1117EW_C_AGE <= Assignment.ADULT_AGE) 
-                                   & (self.p_data.HID == -1)].index
+      c_unassigned = self.pool.unassigned((self.pool.eth == eth) & (self.pool.age <= Assignment.ADULT_AGE))
 
       n_c = len(c_unassigned)
 
-      h_candidates = self.h_data.loc[(self.h_data.Area.isin(oas)) 
-                                   & (self.h_data.LC4202_C_ETHHUK11 == eth)
-                                   & (self.h_data.LC4408_C_AHTHUK11.isin([2,3,4,5])) 
-                                   & (self.h_data.FILLED == False)].index
+      h_candidates = self.state.households(oas)
+      h_candidates = h_candidates[(self.state.h_eth[h_candidates] == eth)
+                                  & np.isin(self.state.h_type[h_candidates], [2, 3, 4, 5])
+                                  & ~self.state.filled[h_candidates]]
 
       if len(h_candidates) and n_c:
-        h_sample = np.random.choice(h_candidates, n_c, replace=True)
+        h_sample = self.rng.choice(h_candidates, n_c, replace=True)
 
-        self.p_data.loc[c_unassigned, "HID"] = h_sample
+        self.state.assign(c_unassigned, h_sample)
+        self.pool.remove(c_unassigned)
 
 
   def stats(self):
-    print("P:", 100 * len(self.p_data[self.p_data.HID > 0]) / len(self.p_data), "rem:", len(self.p_data[self.p_data.HID == -1]))
-    print("H:", 100 * len(self.h_data[self.h_data.FILLED]) / len(self.h_data[self.h_data.LC4408_C_AHTHUK11 > 0]), 
-      "rem:", len(self.h_data[(self.h_data.FILLED == False) & (self.h_data.LC4408_C_AHTHUK11 > 0)]), "(+", len(self.h_data[self.h_data.LC4408_C_AHTHUK11 == -1]), ")")
+    """
+    Progress report from the running totals (no table scans). See check() for a full audit
+    """
+    if self.verbosity < 1:
+      return
+    state = self.state
+    print("P:", 100 * state.n_assigned / max(state.n_people, 1), "rem:", state.n_people - state.n_assigned)
+    print("H:", 100 * state.n_filled / max(state.n_occupied, 1),
+      "rem:", state.n_occupied_unfilled, "(+", state.n_unoccupied, ")")
     
 
-  def check(self):
-
+  @staticmethod
+  def audit(p_data, h_data):
+    """
+    Returns the grouped counts of households (by H_AUDIT) and people (by P_AUDIT) that check() reports on. Counts
+    for subsets of the households and people can be summed
+    """
+    h = h_data
+    households = h.groupby([h.LC4408_C_AHTHUK11.rename("type"),
+                            h.LC4404_C_SIZHUK11.rename("size"),
+                            (h.CommunalSize >= 0).rename("communal"),
+                            h.FILLED.rename("filled"),
+                            (h.HRPID != -1).rename("hrp")]).size().rename("count").reset_index()
+    p = p_data
+    people = p.groupby([(p.DC1117EW_C_AGE > Assignment.ADULT_AGE).rename("adult"),
+                        (p.HID != -1).rename("assigned")]).size().rename("count").reset_index()
+    return households, people
+
+  def check(self, counts=None):
+    """
+    Audit of the assignment from a single grouped count over households (type x size x communal x FILLED x HRP
+    assigned) and over people (adult x assigned), see audit(). Prints a summary and returns the report
+    (see write_results)
+    """
     print("CHECKING...")
 
-    print("occupied households without HRP:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11 > 0) & (self.h_data.HRPID == -1)]))
-    
-    print("occupied households not filled", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11 > 0) & (self.h_data.FILLED == False)]), 
-      "of", len(self.h_data[self.h_data.LC4408_C_AHTHUK11 > 0]))
-    print("communal residences not filled:", len(self.h_data[(self.h_data.CommunalSize >= 0) 
-                                                           & (self.h_data.FILLED == False)]))
-
-    print("single-occupant households not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11 == 1)
-                                                                  & (self.h_data.FILLED == False)]))
-
-    print("single-parent one-child households not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11 == 4)
-                                                                          & (self.h_data.LC4404_C_SIZHUK11 == 2) 
-                                                                          & (self.h_data.FILLED == False)]))
-
-    print("single-parent two-child households not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11 == 4)
-                                                                          & (self.h_data.LC4404_C_SIZHUK11 == 3) 
-                                                                          & (self.h_data.FILLED == False)]))
-
-    print("single-parent 3+-child households not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11 == 4)
-                                                                         & (self.h_data.LC4404_C_SIZHUK11 == 4) 
-                                                                         & (self.h_data.FILLED == False)]))
-
-    print("couple households with no children not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11.isin([2,3])) 
-                                                                          & (self.h_data.LC4404_C_SIZHUK11 == 2) 
-                                                                          & (self.h_data.FILLED == False)]))
-
-    print("couple households with one child not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11.isin([2,3]))
-                                                                        & (self.h_data.LC4404_C_SIZHUK11 == 3) 
-                                                                        & (self.h_data.FILLED == False)]))
-
-    print("couple households with 2+ children not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11.isin([2,3]))
-                                                                          & (self.h_data.LC4404_C_SIZHUK11 == 4) 
-                                                                          & (self.h_data.FILLED == False)]))
-
-    print("mixed (2,3) households not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11 == 5) 
-                                                        & (self.h_data.LC4404_C_SIZHUK11 < 4)
-                                                        & (self.h_data.FILLED == False)]))
-
-    print("mixed (4+) households not filled:", len(self.h_data[(self.h_data.LC4408_C_AHTHUK11 == 5) 
-                                                        & (self.h_data.FILLED == False)]))
-
-    print("adults not assigned", len(self.p_data[(self.p_data.DC1117EW_C_AGE > Assignment.ADULT_AGE) & (self.p_data.HID == -1)]),
-      "of", len(self.p_data[self.p_data.DC1117EW_C_AGE > Assignment.ADULT_AGE]))
-
-    print("children not assigned", len(self.p_data[(self.p_data.DC1117EW_C_AGE <= Assignment.ADULT_AGE) & (self.p_data.HID == -1)]),
-      "of", len(self.p_data[self.p_data.DC1117EW_C_AGE <= Assignment.ADULT_AGE]))
+    households, people = counts if counts is not None else Assignment.audit(self.p_data, self.h_data)
+
+    def count(table, mask):
+      return int(table["count"][mask].sum())
+
+    occupied = households.type > 0
+    unfilled = ~households.filled
+    single_parent = households.type == 4
+    couple = households.type.isin([2, 3])
+    mixed = households.type == 5
+    summary = {
+      "occupied_without_hrp": count(households, occupied & ~households.hrp),
+      "occupied_unfilled": count(households, occupied & unfilled),
+      "occupied": count(households, occupied),
+      "communal_unfilled": count(households, households.communal & unfilled),
+      "single_unfilled": count(households, (households.type == 1) & unfilled),
+      "single_parent_1_child_unfilled": count(households, single_parent & (households["size"] == 2) & unfilled),
+      "single_parent_2_child_unfilled": count(households, single_parent & (households["size"] == 3) & unfilled),
+      "single_parent_3+_child_unfilled": count(households, single_parent & (households["size"] == 4) & unfilled),
+      "couple_0_child_unfilled": count(households, couple & (households["size"] == 2) & unfilled),
+      "couple_1_child_unfilled": count(households, couple & (households["size"] == 3) & unfilled),
+      "couple_2+_child_unfilled": count(households, couple & (households["size"] == 4) & unfilled),
+      "mixed_2_3_unfilled": count(households, mixed & (households["size"] < 4) & unfilled),
+      "mixed_4+_unfilled": count(households, mixed & (households["size"] == 4) & unfilled),
+      "adults_unassigned": count(people, people.adult & ~people.assigned),
+      "adults": count(people, people.adult),
+      "children_unassigned": count(people, ~people.adult & ~people.assigned),
+      "children": count(people, ~people.adult)
+    }
+
+    print("occupied households without HRP:", summary["occupied_without_hrp"])
+    print("occupied households not filled", summary["occupied_unfilled"], "of", summary["occupied"])
+    print("communal residences not filled:", summary["communal_unfilled"])
+    print("single-occupant households not filled:", summary["single_unfilled"])
+    print("single-parent one-child households not filled:", summary["single_parent_1_child_unfilled"])
+    print("single-parent two-child households not filled:", summary["single_parent_2_child_unfilled"])
+    print("single-parent 3+-child households not filled:", summary["single_parent_3+_child_unfilled"])
+    print("couple households with no children not filled:", summary["couple_0_child_unfilled"])
+    print("couple households with one child not filled:", summary["couple_1_child_unfilled"])
+    print("couple households with 2+ children not filled:", summary["couple_2+_child_unfilled"])
+    print("mixed (2,3) households not filled:", summary["mixed_2_3_unfilled"])
+    print("mixed (4+) households not filled:", summary["mixed_4+_unfilled"])
+    print("adults not assigned", summary["adults_unassigned"], "of", summary["adults"])
+    print("children not assigned", summary["children_unassigned"], "of", summary["children"])
+
+    return {"region": self.region, "year": self.year, "summary": summary,
+            "households": households.to_dict("records"), "people": people.to_dict("records")}
+
+
+# per-process copy of the assignment (less the population and household tables) used by the parallel workers
+_worker_template = None
+
+def _init_worker(template):
+  global _worker_template
+  _worker_template = template
+
+def _assign_msoa(task):
+  """
+  Assigns the people and households in a single MSOA, returning the updated HID (people) and HRPID/FILLED (households)
+  and the timing spans
+  """
+  msoa, oas, p_data, h_data, reopen = task
+  assignment = copy.copy(_worker_template)
+  assignment.trace = Trace(_worker_template.trace.enabled)
+  assignment.p_data = p_data.copy()
+  assignment.h_data = h_data.copy()
+  assignment.state = AssignmentState(assignment.p_data, assignment.h_data)
+  assignment.state.reopen = reopen
+  assignment.assign_msoa(msoa, oas)
+  assignment.state.sync(assignment.p_data, assignment.h_data)
+  return assignment.p_data.HID, assignment.h_data[["HRPID", "FILLED"]], assignment.trace.spans
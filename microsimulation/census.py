@@ -0,0 +1,61 @@
+"""
+Local columnar store of the census tables used by the static population microsimulation
+Requires pyarrow
+"""
+
+import os
+
+class CensusStore:
+  """
+  The census tables returned by common.Base.get_census_data (DC1117, DC2101 and DC6206, or the synthesised Scottish
+  equivalents) for any number of LADs, stored as parquet in directory path, one file per resolution, table and LAD, i.e.
+  path/<resolution>/<table>/LAD=<lad>/part-0.parquet. Built once (see scripts/ingest_census.py), after which a LAD's
+  tables are read directly from its files, offline and without constructing the census api clients
+  """
+
+  TABLES = ["DC1117", "DC2101", "DC6206"]
+
+  def __init__(self, path):
+    self.path = path
+
+  def contains(self, lad, resolution):
+    """
+    Returns whether the tables for lad at resolution are in the store
+    """
+    return os.path.isfile(self.__file(lad, resolution, CensusStore.TABLES[0]))
+
+  def read(self, lad, resolution):
+    """
+    Returns the tables for lad at resolution (None for any not stored, e.g. DC6206 for Scotland), as per
+    get_census_data
+    """
+    import pyarrow.parquet as pq
+
+    tables = []
+    for table in CensusStore.TABLES:
+      filename = self.__file(lad, resolution, table)
+      tables.append(pq.read_table(filename).to_pandas() if os.path.isfile(filename) else None)
+    return tuple(tables)
+
+  def write(self, lad, resolution, tables):
+    """
+    Adds (or replaces) the tables (as returned by get_census_data) for lad at resolution
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # the first table marks the LAD as present (see contains) so is written last
+    for table, data in reversed(list(zip(CensusStore.TABLES, tables))):
+      filename = self.__file(lad, resolution, table)
+      if data is None:
+        if os.path.isfile(filename):
+          os.remove(filename)
+        continue
+      os.makedirs(os.path.dirname(filename), exist_ok=True)
+      # write to a temporary file then rename so that readers never see a partial file
+      tmp_file = "%s.%d.tmp" % (filename, os.getpid())
+      pq.write_table(pa.Table.from_pandas(data, preserve_index=False), tmp_file)
+      os.replace(tmp_file, filename)
+
+  def __file(self, lad, resolution, table):
+    return os.path.join(self.path, resolution, table, "LAD=" + lad, "part-0.parquet")
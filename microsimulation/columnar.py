@@ -0,0 +1,55 @@
+"""
+Columnar (Parquet/Feather) storage of microsimulation output, partitioned by MSOA and year
+Requires pyarrow
+"""
+
+import numpy as np
+
+FORMATS = ["parquet", "feather"]
+
+def encode(data):
+  """
+  Returns a copy of data with Area codes dictionary-encoded (categorical) and the census category columns (*_C_*,
+  QS420_CELL) as narrow integers
+  """
+  data = data.copy()
+  for col in data.columns:
+    if col == "Area":
+      data[col] = data[col].astype("category")
+    elif "_C_" in col or col == "QS420_CELL":
+      data[col] = data[col].astype(np.int16)
+  return data
+
+def write(data, path, msoas, year, fmt="parquet"):
+  """
+  Writes data (with its index) to the dataset in directory path, hive-partitioned by MSOA (msoas is the MSOA of each
+  row) and year, i.e. path/MSOA=<msoa>/year=<year>/part-0.<fmt>. Existing files for the same partitions are replaced
+  """
+  import pyarrow as pa
+  import pyarrow.dataset as ds
+
+  if fmt not in FORMATS:
+    raise ValueError("invalid columnar format {}, must be one of {}".format(fmt, FORMATS))
+
+  data = encode(data)
+  data["MSOA"] = np.where(np.asarray(msoas) == "", None, msoas)
+  data["year"] = year
+  ds.write_dataset(pa.Table.from_pandas(data, preserve_index=True), path, format=fmt,
+                   partitioning=ds.partitioning(pa.schema([("MSOA", pa.string()), ("year", pa.int32())]), flavor="hive"),
+                   basename_template="part-{i}." + fmt, existing_data_behavior="overwrite_or_ignore")
+
+def read(path, msoas=None, years=None, columns=None, fmt="parquet"):
+  """
+  Reads (a subset of) a dataset written by write. Only the partitions for the given msoas and years (default all) are
+  read, and only the given columns (default all, including MSOA and year)
+  """
+  import pyarrow.dataset as ds
+
+  dataset = ds.dataset(path, format=fmt, partitioning="hive")
+  condition = None
+  if msoas is not None:
+    condition = ds.field("MSOA").isin(list(msoas))
+  if years is not None:
+    in_years = ds.field("year").isin([int(year) for year in years])
+    condition = in_years if condition is None else condition & in_years
+  return dataset.to_table(columns=columns, filter=condition).to_pandas()
@@ -15,18 +15,26 @@ class Base(object):
   Microsimulation base class - common functionality
   """
 
-  def __init__(self, region, resolution, cache_dir):
+  def __init__(self, region, resolution, cache_dir, census_store=None):
     self.region = region
     self.resolution = resolution
-    self.data_api_en = Api_ew.Nomisweb(cache_dir)
-    self.data_api_sc = Api_sc.NRScotland(cache_dir)
+    self.cache_dir = cache_dir
+    # local copy of the census tables (see CensusStore), if any
+    self.census_store = census_store
+    # census api clients, only constructed if/when the data isn't in the store
+    self.data_api_en = None
+    self.data_api_sc = None
 
   def get_census_data(self):
+    if self.census_store is not None and self.census_store.contains(self.region, self.resolution):
+      return self.census_store.read(self.region, self.resolution)
     if self.region[0] == "S":
+      self.data_api_sc = Api_sc.NRScotland(self.cache_dir)
       return self.__get_census_data_sc()
     elif self.region[0] == "N":
       raise NotImplementedError("NI support not yet implemented")
     else:
+      self.data_api_en = Api_ew.Nomisweb(self.cache_dir)
       return self.__get_census_data_ew()
 
   def __get_census_data_sc(self):
@@ -0,0 +1,56 @@
+"""
+Storage of static population microsimulation output as contingency tables (counts by area, sex, age and ethnicity)
+rather than one row per person
+"""
+
+import numpy as np
+import pandas as pd
+
+# the dimensions of the count array, as per the (person) table columns
+COLUMNS = ["Area", "DC1117EW_C_SEX", "DC1117EW_C_AGE", "DC2101EW_C_ETHPUK11"]
+
+def write(filename, counts, areas, eths):
+  """
+  Writes the (area x sex x age x eth) integer count array to filename as a compressed numpy (.npz) archive, with the
+  area and eth codes of the first and last dimensions (sex is 1,2 and age 1..86)
+  """
+  np.savez_compressed(filename, counts=np.asarray(counts).astype(np.int32), areas=np.asarray(areas).astype(str),
+                      eths=np.asarray(eths))
+
+def read(filename):
+  """
+  Reads a file written by write. Returns the count array and a list of the category values of each dimension
+  """
+  with np.load(filename) as data:
+    counts = data["counts"]
+    categories = [data["areas"], np.array([1, 2]), np.arange(1, counts.shape[2] + 1), data["eths"]]
+  return counts, categories
+
+def cells(filename):
+  """
+  Returns the non-zero cells of a file written by write as a table with the person table columns and a count
+  """
+  counts, categories = read(filename)
+  index = np.nonzero(counts)
+  table = pd.DataFrame({column: values[i] for column, values, i in zip(COLUMNS, categories, index)})
+  table["count"] = counts[index]
+  return table
+
+def expand(filename, areas=None):
+  """
+  Lazily expands a file written by write into individuals, yielding a table (as per the csv output, indexed by PID)
+  for each area in turn, optionally only those in areas. People are in cell order and PIDs are as for the full
+  population, so are the same whichever areas are expanded
+  """
+  counts, categories = read(filename)
+  # PID of the first person in each area
+  first = np.concatenate(([0], np.cumsum(counts.sum((1, 2, 3)))))
+  for a, area in enumerate(categories[0]):
+    if areas is not None and area not in areas:
+      continue
+    # repeat the (sex, age, eth) cell indices by their counts
+    index = np.unravel_index(np.repeat(np.arange(counts[a].size), counts[a].ravel()), counts[a].shape)
+    table = pd.DataFrame({column: values[i] for column, values, i in zip(COLUMNS[1:], categories[1:], index)},
+                         index=pd.RangeIndex(first[a], first[a + 1], name="PID"))
+    table.insert(0, "Area", area)
+    yield table
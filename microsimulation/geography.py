@@ -0,0 +1,151 @@
+"""
+Indexed OA -> MSOA -> LAD geography lookup
+"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+class GeogLookup:
+  """
+  GB census geography hierarchy (OA -> MSOA -> LAD) precompiled into an indexed binary form.
+  Codes are dictionary-encoded, OAs are stored grouped by MSOA (CSR offsets) and MSOAs grouped by LAD (ranges), so
+  hierarchy lookups are index operations rather than scans of the full table. The compiled arrays are stored as .npy
+  files in a directory alongside the csv (with the size and modification time of the csv they were compiled from) and
+  memory-mapped when loaded.
+  """
+
+  ARRAYS = ["lad_codes", "lad_msoa_ptr", "msoa_codes", "msoa_order", "msoa_lad", "msoa_oa_ptr", "oa_codes", "oa_order", "oa_msoa"]
+
+  def __init__(self, arrays):
+    for name in GeogLookup.ARRAYS:
+      setattr(self, name, arrays[name])
+
+  @staticmethod
+  def load(path, csv_file=None):
+    """
+    Loads the compiled lookup from path, first (re)compiling it from csv_file (default path + ".csv.gz") if it's
+    missing or was compiled from a different version of csv_file
+    """
+    csv_file = csv_file if csv_file else path + ".csv.gz"
+    if not os.path.isdir(path) or GeogLookup.__stale(path, csv_file):
+      GeogLookup.compile(csv_file, path)
+    return GeogLookup({name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in GeogLookup.ARRAYS})
+
+  @staticmethod
+  def compile(csv_file, path):
+    """
+    Compiles the lookup csv (with OA, MSOA and LAD columns) into binary form in directory path
+    """
+    lookup = pd.read_csv(csv_file, usecols=["OA", "MSOA", "LAD"], compression="infer")
+
+    lad_codes, oa_lad = np.unique(lookup.LAD.values.astype(str), return_inverse=True)
+    msoa_keys = lookup.drop_duplicates("MSOA")
+    msoa_keys = msoa_keys.assign(lad=oa_lad[msoa_keys.index]).sort_values(["lad", "MSOA"])
+    # MSOAs ordered by LAD so that each LAD is a contiguous range
+    msoa_codes = msoa_keys.MSOA.values.astype(str)
+    msoa_lad = msoa_keys.lad.values
+    msoa_index = pd.Series(np.arange(len(msoa_codes)), index=msoa_codes)
+
+    # OAs grouped by MSOA (stable so that the original order is preserved within each MSOA)
+    oa_msoa = msoa_index[lookup.MSOA.values.astype(str)].values
+    oa_perm = np.argsort(oa_msoa, kind="stable")
+    oa_msoa = oa_msoa[oa_perm]
+    oa_codes = lookup.OA.values.astype(str)[oa_perm]
+
+    arrays = {
+      "lad_codes": lad_codes.astype(bytes),
+      "lad_msoa_ptr": np.concatenate([[0], np.cumsum(np.bincount(msoa_lad, minlength=len(lad_codes)))]),
+      "msoa_codes": msoa_codes.astype(bytes),
+      "msoa_order": np.argsort(msoa_codes),
+      "msoa_lad": msoa_lad,
+      "msoa_oa_ptr": np.concatenate([[0], np.cumsum(np.bincount(oa_msoa, minlength=len(msoa_codes)))]),
+      "oa_codes": oa_codes.astype(bytes),
+      "oa_order": np.argsort(oa_codes),
+      "oa_msoa": oa_msoa
+    }
+
+    # write to a temporary directory then rename, in case other processes are doing the same
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, array in arrays.items():
+      np.save(os.path.join(tmp_path, name + ".npy"), array)
+    np.save(os.path.join(tmp_path, "source.npy"), GeogLookup.__source(csv_file))
+    # move any stale version out of the way first
+    old_path = "%s.%d.old" % (path, os.getpid())
+    try:
+      os.rename(path, old_path)
+    except OSError:
+      old_path = None
+    try:
+      os.rename(tmp_path, path)
+    except OSError:
+      # already compiled by another process
+      shutil.rmtree(tmp_path)
+    if old_path:
+      shutil.rmtree(old_path)
+
+  @staticmethod
+  def __source(csv_file):
+    """
+    Returns the size and modification time of csv_file, to detect changes to it
+    """
+    stat = os.stat(csv_file)
+    return np.array([stat.st_size, stat.st_mtime_ns])
+
+  @staticmethod
+  def __stale(path, csv_file):
+    """
+    Returns whether the lookup in path was compiled from a different version of csv_file (if present)
+    """
+    if not os.path.isfile(csv_file):
+      return False
+    source = os.path.join(path, "source.npy")
+    return not os.path.isfile(source) or not np.array_equal(np.load(source), GeogLookup.__source(csv_file))
+
+  @staticmethod
+  def __find(codes, order, code):
+    """
+    Returns the index of code in (dictionary) codes, or -1 if not present
+    """
+    code = np.asarray(code).astype(bytes)
+    # longer than any code (the cast below would truncate it)
+    too_long = np.char.str_len(code) > codes.dtype.itemsize
+    code = code.astype(codes.dtype)
+    i = np.searchsorted(codes, code, sorter=order)
+    i = np.minimum(i, len(codes) - 1)
+    index = np.asarray(order[i])
+    return np.where((codes[index] == code) & ~too_long, index, -1)
+
+  def oas_for_msoa(self, msoa):
+    """
+    Returns the OA codes in msoa (empty if msoa unknown)
+    """
+    i = int(GeogLookup.__find(self.msoa_codes, self.msoa_order, msoa))
+    if i == -1:
+      return np.array([], dtype=str)
+    return self.oa_codes[self.msoa_oa_ptr[i]:self.msoa_oa_ptr[i + 1]].astype(str)
+
+  def msoas_for_lad(self, lad):
+    """
+    Returns the MSOA codes in lad (empty if lad unknown)
+    """
+    i = int(GeogLookup.__find(self.lad_codes, np.arange(len(self.lad_codes)), lad))
+    if i == -1:
+      return np.array([], dtype=str)
+    return self.msoa_codes[self.lad_msoa_ptr[i]:self.lad_msoa_ptr[i + 1]].astype(str)
+
+  def msoa_for_oa(self, oas):
+    """
+    Returns the MSOA code of each of the OA codes in oas (empty string if unknown)
+    """
+    i = GeogLookup.__find(self.oa_codes, self.oa_order, oas)
+    return np.where(i >= 0, self.msoa_codes[self.oa_msoa[i]].astype(str), "")
+
+  def lad_for_msoa(self, msoas):
+    """
+    Returns the LAD code of each of the MSOA codes in msoas (empty string if unknown)
+    """
+    i = GeogLookup.__find(self.msoa_codes, self.msoa_order, msoas)
+    return np.where(i >= 0, self.lad_codes[self.msoa_lad[i]].astype(str), "")
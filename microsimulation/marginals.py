@@ -0,0 +1,136 @@
+"""
+Precomputed age-sex marginals for the static population microsimulation
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+import ukpopulation.nppdata as nppdata
+import ukpopulation.snppdata as snppdata
+import ukpopulation.customsnppdata as customsnppdata
+import ukpopulation.myedata as myedata
+
+class AgeSexMarginals:
+  """
+  Dense (LAD x year x sex x age) age-sex marginals of a projection variant, from mid-year estimates before the start of
+  the SNPP, then SNPP (with the NPP variant applied where available). Ages are census categories, i.e. 0..84 and 85+.
+  Any not already cached are built in a single pass over the estimates/projections for the LADs missing the same years
+  and cached in cache_dir, one file per LAD (delete age_sex_<variant>_<lad>.npz to rebuild after the underlying data
+  changes), so that concurrent runs for different LADs don't overwrite each other. Load once and pass to each
+  SequentialMicrosynthesis to share between regions
+  """
+
+  SEXES = 2
+  AGES = 86
+
+  def __init__(self, variant, is_custom=False, cache_dir="./cache", mye_api=None, npp_api=None, snpp_api=None):
+    self.variant = variant
+    self.is_custom = is_custom
+    self.cache_dir = cache_dir
+    # population apis, created if/when needed
+    self.mye_api = mye_api
+    self.npp_api = npp_api
+    self.snpp_api = snpp_api
+
+    # years and (year x sex x age) cube of each LAD, loaded in cover
+    self.data = {}
+
+  def cover(self, lads, years):
+    """
+    Ensures the marginals for the given LADs and years are available, loading them from the cache and building (and
+    caching) only those missing
+    """
+    # LADs grouped by the years they're missing
+    missing = {}
+    for lad in lads:
+      if lad not in self.data:
+        self.data[lad] = self.__load(lad)
+      lad_years = tuple(np.setdiff1d(years, self.data[lad][0]).astype(int))
+      if lad_years:
+        missing.setdefault(lad_years, []).append(lad)
+
+    for years, lads in missing.items():
+      years = np.array(years)
+      lads = np.array(sorted(lads))
+      print("Building age-sex marginals for", len(lads), "LAD(s),", years[0], "-", years[-1], "...", end="", flush=True)
+      cube = self.__build(lads, years)
+      for lad, lad_cube in zip(lads, cube):
+        # merge into the cached file, which may have been extended by a concurrent run
+        cached_years, cached_cube = self.__load(lad)
+        keep = ~np.isin(cached_years, years)
+        lad_years = np.concatenate((cached_years[keep], years))
+        order = np.argsort(lad_years)
+        self.data[lad] = (lad_years[order], np.concatenate((cached_cube[keep], lad_cube))[order])
+        # write to a temporary file then rename so that concurrent runs never see a partial file
+        filename = self.__file(lad)
+        tmp_file = filename + "." + str(os.getpid()) + ".npz"
+        np.savez_compressed(tmp_file, years=self.data[lad][0], cube=self.data[lad][1])
+        os.replace(tmp_file, filename)
+      print("OK")
+
+  def marginal(self, lad, year):
+    """
+    Returns the (sex x age) marginal for lad in year, which must have been covered (see cover)
+    """
+    years, cube = self.data.get(lad, (np.array([], dtype=int), None))
+    j = np.searchsorted(years, year)
+    if j == len(years) or years[j] != year:
+      raise ValueError("age-sex marginal for %s in %s not available, see AgeSexMarginals.cover" % (lad, year))
+    return cube[j]
+
+  def __file(self, lad):
+    return os.path.join(self.cache_dir, "age_sex_%s_%s.npz" % (self.variant, lad))
+
+  def __load(self, lad):
+    filename = self.__file(lad)
+    if not os.path.isfile(filename):
+      return np.array([], dtype=int), np.zeros((0, AgeSexMarginals.SEXES, AgeSexMarginals.AGES), dtype=int)
+    with np.load(filename) as data:
+      return data["years"], data["cube"]
+
+  def __build(self, lads, years):
+    self.__init_apis()
+    # the data sources depend on the LAD's SNPP year range (i.e. its country)
+    groups = {}
+    for lad in lads:
+      groups.setdefault(self.snpp_api.min_year(lad), []).append(lad)
+
+    tables = []
+    for min_year, codes in groups.items():
+      mye_years = [int(year) for year in years if year < min_year]
+      snpp_years = [int(year) for year in years if year >= min_year and (year < self.npp_api.min_year() or self.is_custom)]
+      variant_years = [int(year) for year in years if year >= min_year and year >= self.npp_api.min_year()
+                       and not self.is_custom]
+      if mye_years:
+        tables.append(self.mye_api.filter(codes, mye_years))
+      if snpp_years:
+        tables.append(self.snpp_api.filter(codes, snpp_years))
+      if variant_years:
+        tables.append(self.snpp_api.create_variant(self.variant, self.npp_api, codes, variant_years))
+    data = pd.concat(tables, ignore_index=True, sort=False)
+
+    # one weighted count over all LADs, years, sexes and ages, aggregating 85 and over into 85
+    shape = (len(lads), len(years), AgeSexMarginals.SEXES, AgeSexMarginals.AGES)
+    index = np.ravel_multi_index((np.searchsorted(lads, data.GEOGRAPHY_CODE.values),
+                                  np.searchsorted(years, data.PROJECTED_YEAR_NAME.values),
+                                  data.GENDER.values - 1,
+                                  np.minimum(data.C_AGE.values, AgeSexMarginals.AGES - 1)), shape)
+    cube = np.bincount(index, weights=data.OBS_VALUE.values, minlength=np.prod(shape)).reshape(shape)
+    # a source with no data for a LAD and year would otherwise be cached as an empty marginal
+    empty = np.argwhere(cube.sum(axis=(2, 3)) == 0)
+    if len(empty):
+      raise ValueError("no age-sex data for %s" % ", ".join("%s in %d" % (lads[i], years[j]) for i, j in empty))
+    # truncated to integers as per utils.unlistify
+    return cube.astype(int)
+
+  def __init_apis(self):
+    if self.mye_api is None:
+      self.mye_api = myedata.MYEData(self.cache_dir)
+    if self.npp_api is None:
+      self.npp_api = nppdata.NPPData(self.cache_dir)
+    if self.snpp_api is None:
+      if self.is_custom:
+        self.snpp_api = customsnppdata.CustomSNPPData(self.variant, self.cache_dir)
+      else:
+        self.snpp_api = snppdata.SNPPData(self.cache_dir)
@@ -0,0 +1,125 @@
+"""
+Contingency-table (count) based matching of sampled characteristics to people
+"""
+
+import numpy as np
+
+class CountMatcher:
+  """
+  Matches demand (sampled age, sex and eth, e.g. of HRPs) to the unassigned people in a PersonPool by operating on
+  counts per (age, sex, eth) cell rather than searching for each person in turn.
+  Matching proceeds through progressively relaxed levels, as per the closest-fit search: exact, then nearest age with
+  the same sex and eth, then nearest age with the same sex, then (if relax_sex) nearest age. At each level counts are
+  transferred from demand cells to supply cells at increasing age distance (younger first where equidistant), each
+  step being a few array operations over the whole count table. Matched counts are only turned into people (taken
+  from the pool in table order) at the end.
+  """
+
+  def __init__(self, pool, min_age=None, max_age=None, relax_sex=True):
+    """
+    People are only matched by a relaxed level if their age is in [min_age, max_age] (exact matches are at any age, as
+    per PersonPool.take_n)
+    """
+    self.pool = pool
+    self.min_age = min_age
+    self.max_age = max_age
+    self.relax_sex = relax_sex
+
+  def match(self, ages, sexes, eths):
+    """
+    Finds (and removes from the pool) a person for each of the given characteristics
+    Returns the ids of the people (as per the pool index), -1 where not found
+    """
+    ages = np.asarray(ages)
+    sexes = np.asarray(sexes)
+    eths = np.asarray(eths)
+    result = np.full(len(ages), -1, dtype=int)
+    pool = self.pool
+    free = pool.free
+    if not len(ages) or not np.any(free):
+      return result
+
+    # index the union of the demand and supply values: age by offset (so that adjacent ages are adjacent), sex and eth
+    # by value
+    age0 = min(ages.min(), pool.age[free].min())
+    sex_values = np.unique(np.concatenate((sexes, pool.sex[free])))
+    eth_values = np.unique(np.concatenate((eths, pool.eth[free])))
+    shape = (max(ages.max(), pool.age[free].max()) - age0 + 1, len(sex_values), len(eth_values))
+
+    def cells(age, sex, eth):
+      return np.ravel_multi_index((age - age0, np.searchsorted(sex_values, sex), np.searchsorted(eth_values, eth)), shape)
+
+    d_cells = cells(ages, sexes, eths)
+    demand = np.bincount(d_cells, minlength=np.prod(shape)).reshape(shape)
+    supply = np.bincount(cells(pool.age[free], pool.sex[free], pool.eth[free]),
+                         minlength=np.prod(shape)).reshape(shape)
+
+    # each level groups cells as (age, group, subcell): the counts are matched by group, then split over subcells
+    n_sex, n_eth = shape[1:]
+    levels = [(n_sex * n_eth, 1), (n_sex, n_eth)]
+    if self.relax_sex:
+      levels.append((1, n_sex * n_eth))
+
+    # exact matches first, from all the supply, then only the supply aged in [min_age, max_age] for the relaxed levels
+    transfers = []
+    CountMatcher.__transfer(demand.reshape(shape[0], *levels[0]), supply.reshape(shape[0], *levels[0]), 0, transfers)
+    s_ages = np.arange(shape[0]) + age0
+    if self.min_age is not None:
+      supply[s_ages < self.min_age] = 0
+    if self.max_age is not None:
+      supply[s_ages > self.max_age] = 0
+
+    for groups, subcells in levels:
+      # (reshaped) views, so updates apply to the full tables
+      d = demand.reshape(shape[0], groups, subcells)
+      s = supply.reshape(shape[0], groups, subcells)
+      for distance in range(shape[0]):
+        if not demand.any() or not supply.any():
+          break
+        for shift in ([0] if distance == 0 else [-distance, distance]):
+          CountMatcher.__transfer(d, s, shift, transfers)
+
+    # convert the matched counts into people, assigning them to the demand in order
+    units = np.argsort(d_cells, kind="stable")
+    cursor = np.concatenate(([0], np.cumsum(np.bincount(d_cells, minlength=np.prod(shape)))))
+    for d_cell, s_cell, count in transfers:
+      age, sex, eth = np.unravel_index(s_cell, shape)
+      taken = pool.take_n(age + age0, sex_values[sex], eth_values[eth], count)
+      result[units[cursor[d_cell]:cursor[d_cell] + len(taken)]] = taken
+      cursor[d_cell] += count
+    return result
+
+  @staticmethod
+  def __transfer(d, s, shift, transfers):
+    """
+    Matches demand at age a with supply at age a + shift, in each group, updating the (age, group, subcell) count
+    tables d and s in place. Appends the (demand cell, supply cell, count) of each match to transfers
+    """
+    n = d.shape[0]
+    if abs(shift) >= n:
+      return
+    d_ages = slice(max(0, -shift), n - max(0, shift))
+    s_ages = slice(max(0, shift), n - max(0, -shift))
+    dem = d[d_ages]
+    sup = s[s_ages]
+    total = np.minimum(dem.sum(axis=2), sup.sum(axis=2))
+    if not total.any():
+      return
+
+    # pair the first total demand units with the first total supply units (both in subcell order), by the overlap of
+    # their cumulative count intervals
+    d_hi = np.cumsum(dem, axis=2)
+    s_hi = np.cumsum(sup, axis=2)
+    hi = np.minimum(np.minimum(d_hi[..., :, None], s_hi[..., None, :]), total[..., None, None])
+    lo = np.maximum((d_hi - dem)[..., :, None], (s_hi - sup)[..., None, :])
+    pairs = np.maximum(hi - lo, 0)
+
+    dem -= pairs.sum(axis=3)
+    sup -= pairs.sum(axis=2)
+
+    age, group, d_sub, s_sub = np.nonzero(pairs)
+    groups, subcells = d.shape[1:]
+    base = group * subcells
+    d_cells = (age + d_ages.start) * groups * subcells + base + d_sub
+    s_cells = (age + s_ages.start) * groups * subcells + base + s_sub
+    transfers.extend(zip(d_cells, s_cells, pairs[age, group, d_sub, s_sub]))
@@ -0,0 +1,147 @@
+"""
+Pools of unassigned people used by the assignment algorithm
+"""
+
+from bisect import bisect_left
+from collections import deque
+import numpy as np
+import pandas as pd
+
+class PersonPool:
+  """
+  Unassigned people in a single MSOA, indexed by (Area, age, sex, ethnicity)
+  Built once per MSOA. Each category holds its people in person table order, so taking the next available person
+  is equivalent to taking the first match of a (HID == -1) filter over the full table, but costs O(1)
+  For nearest-age matching the categories are also indexed by age within (sex, eth), (sex) and () groups, so the
+  closest available person in a group is found by bisection over (at most 86) ages rather than a scan of the people
+  """
+
+  def __init__(self, msoa, index, age, sex, eth):
+    """
+    index, age, sex and eth are arrays describing the unassigned people in msoa, in table order. index can be
+    PIDs or row positions, and is what the pool returns
+    """
+    self.area = msoa
+
+    self.index = pd.Index(index)
+    self.age = np.asarray(age)
+    self.sex = np.asarray(sex)
+    self.eth = np.asarray(eth)
+    # people are never added to a pool, only removed
+    self.free = np.ones(len(self.index), dtype=bool)
+
+    # positions (in table order) of the people in each (age, sex, eth) category
+    self.cells = {}
+    # group -> age -> positions, and group -> sorted list of ages with (possibly) unassigned people
+    self.queues = {}
+    self.ages = {}
+    if len(self.index):
+      people = pd.DataFrame({"DC1117EW_C_AGE": self.age, "DC1117EW_C_SEX": self.sex, "DC2101EW_C_ETHPUK11": self.eth})
+      groups = people.groupby(["DC1117EW_C_AGE", "DC1117EW_C_SEX", "DC2101EW_C_ETHPUK11"], sort=False).indices
+      self.cells = {key: deque(positions) for key, positions in groups.items()}
+      for (age, sex, eth), cell in self.cells.items():
+        self.queues.setdefault((sex, eth), {})[age] = cell
+      for (age, sex), positions in people.groupby(["DC1117EW_C_AGE", "DC1117EW_C_SEX"], sort=False).indices.items():
+        self.queues.setdefault((sex,), {})[age] = deque(positions)
+      for age, positions in people.groupby("DC1117EW_C_AGE", sort=False).indices.items():
+        self.queues.setdefault((), {})[age] = deque(positions)
+      self.ages = {group: sorted(queues) for group, queues in self.queues.items()}
+
+  def __len__(self):
+    return int(self.free.sum())
+
+  def take(self, age, sex, eth):
+    """
+    Removes and returns (as a list, empty if none available) the next unassigned person with the given characteristics
+    """
+    return self.take_n(age, sex, eth, 1)
+
+  def take_n(self, age, sex, eth, n):
+    """
+    Removes and returns (in table order) up to n unassigned people with the given characteristics
+    """
+    taken = []
+    cell = self.cells.get((age, sex, eth))
+    if cell is None:
+      return taken
+    # people assigned by other means are removed lazily
+    while cell and len(taken) < n:
+      pos = cell.popleft()
+      if self.free[pos]:
+        self.free[pos] = False
+        taken.append(self.index[pos])
+    return taken
+
+  def remove(self, pids):
+    """
+    Removes people that have been assigned to a household
+    """
+    pids = np.atleast_1d(pids)
+    if not len(pids):
+      return
+    positions = self.index.get_indexer(pids)
+    if np.any(positions < 0):
+      raise ValueError("person(s) not in pool for {}".format(self.area))
+    self.free[positions] = False
+
+  def unassigned(self, mask=None):
+    """
+    Returns the (table-ordered) ids of the unassigned people, optionally restricted by a boolean mask over the pool,
+    e.g. pool.unassigned(pool.age > 16)
+    """
+    if mask is None:
+      return self.index[self.free]
+    return self.index[self.free & mask]
+
+  def nearest(self, age, sex=None, eth=None, min_age=None, max_age=None):
+    """
+    Returns (as a list, empty if none available) the unassigned person of the given sex and eth (if specified) with
+    age in [min_age, max_age] that is closest to age. Ties are resolved by table order, as per idxmin on a filtered
+    table. The person is not removed from the pool
+    """
+    if eth is not None:
+      group = (sex, eth)
+    elif sex is not None:
+      group = (sex,)
+    else:
+      group = ()
+    ages = self.ages.get(group)
+    if not ages:
+      return []
+    queues = self.queues[group]
+
+    # nearest age at or above, discarding ages with no one left
+    i = bisect_left(ages, age if min_age is None else max(age, min_age))
+    above = None
+    while i < len(ages) and (max_age is None or ages[i] <= max_age):
+      if self.__head(queues[ages[i]]) is not None:
+        above = ages[i]
+        break
+      del ages[i]
+    # nearest age below
+    j = bisect_left(ages, age if max_age is None else min(age, max_age + 1)) - 1
+    below = None
+    while j >= 0 and (min_age is None or ages[j] >= min_age):
+      if self.__head(queues[ages[j]]) is not None:
+        below = ages[j]
+        break
+      del ages[j]
+      j -= 1
+
+    if above is None and below is None:
+      return []
+    if below is None or (above is not None and above - age < age - below):
+      pos = queues[above][0]
+    elif above is None or age - below < above - age:
+      pos = queues[below][0]
+    else:
+      pos = min(queues[above][0], queues[below][0])
+    return [self.index[pos]]
+
+  def __head(self, queue):
+    """
+    Discards assigned people from the front of queue, returning the position of the first unassigned person (or None)
+    """
+    while queue and not self.free[queue[0]]:
+      queue.popleft()
+    return queue[0] if queue else None
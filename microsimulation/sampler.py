@@ -0,0 +1,78 @@
+"""
+Precompiled conditional samplers for the microdata distributions used in assignment
+"""
+
+import numpy as np
+import pandas as pd
+
+class ConditionalSampler:
+  """
+  Weighted sampling of the rows of a distribution table, conditional on the values of some key columns
+  The table is compiled once into cumulative weights per key, for each level of a fallback chain of progressively
+  less specific keys, e.g. [["agehrp", "ethhuk11"], ["agehrp"], []]. A draw uses the most specific level that has
+  rows matching its key.
+  """
+
+  def __init__(self, dist, fallbacks, weights="n"):
+    self.fallbacks = [list(cols) for cols in fallbacks]
+    key_cols = self.fallbacks[0]
+    # position of each level's columns within the full key
+    self.key_index = [[key_cols.index(col) for col in cols] for cols in self.fallbacks]
+
+    w = dist[weights].values.astype(float)
+    self.tables = []
+    for cols in self.fallbacks:
+      if cols:
+        groups = dist.groupby(cols, sort=False).indices
+      else:
+        groups = {(): np.arange(len(dist))}
+      table = {}
+      for key, rows in groups.items():
+        if not isinstance(key, tuple):
+          key = (key,)
+        table[key] = (rows, np.cumsum(w[rows]))
+      self.tables.append(table)
+
+    # full key -> (level, rows, cumulative weights)
+    self.resolved = {}
+
+  def resolve(self, key):
+    """
+    Returns the fallback level, rows and cumulative weights used for draws with the given (full) key
+    level is None if no level has matching rows
+    """
+    key = tuple(key)
+    if key not in self.resolved:
+      self.resolved[key] = (None, None, None)
+      for level, table in enumerate(self.tables):
+        subkey = tuple(key[i] for i in self.key_index[level])
+        if subkey in table:
+          self.resolved[key] = (level,) + table[subkey]
+          break
+    return self.resolved[key]
+
+  def sample(self, keys, max_level=None, rng=None):
+    """
+    Draws one row for each row of keys (values of the full key columns). Draws sharing a key are made together
+    rng is the (numpy) random generator to use, by default the global numpy random state
+    Returns arrays of the positions of the sampled rows in the table and the fallback levels used, both -1 where no
+    row could be sampled (no matching rows, or only at a level above max_level)
+    """
+    keys = np.asarray(keys).reshape(-1, len(self.fallbacks[0]))
+    n = len(keys)
+    rows = np.full(n, -1, dtype=int)
+    levels = np.full(n, -1, dtype=int)
+    if not n:
+      return rows, levels
+
+    u = (rng if rng is not None else np.random).random(n)
+    groups = pd.DataFrame(keys).groupby(list(range(keys.shape[1])), sort=False).indices
+    for key, pos in groups.items():
+      if not isinstance(key, tuple):
+        key = (key,)
+      level, key_rows, cumw = self.resolve(key)
+      if level is None or (max_level is not None and level > max_level):
+        continue
+      rows[pos] = key_rows[np.searchsorted(cumw, u[pos] * cumw[-1], side="right")]
+      levels[pos] = level
+    return rows, levels
@@ -0,0 +1,123 @@
+"""
+Array-backed state for the assignment algorithm
+"""
+
+import numpy as np
+
+class AssignmentState:
+  """
+  The person and household attributes used by assignment, and the (mutable) linkage between them, held as
+  contiguous arrays indexed by row position in the person/household tables.
+  Linkage is stored by position (-1 meaning unassigned) and only converted to PID/HID when synced back to the tables
+  Linkage should be updated via assign/set_hrp/fill, which maintain running totals for progress reporting
+  """
+
+  def __init__(self, p_data, h_data):
+    # people
+    self.p_ids = p_data.index.values
+    self.p_area = p_data.Area.values
+    self.p_age = p_data.DC1117EW_C_AGE.values
+    self.p_sex = p_data.DC1117EW_C_SEX.values
+    self.p_eth = p_data.DC2101EW_C_ETHPUK11.values
+    # households
+    self.h_ids = h_data.index.values
+    self.h_type = h_data.LC4408_C_AHTHUK11.values
+    self.h_size = h_data.LC4404_C_SIZHUK11.values
+    self.h_eth = h_data.LC4202_C_ETHHUK11.values
+    self.h_ctype = h_data.QS420_CELL.values
+    self.h_csize = h_data.CommunalSize.values
+
+    # household (position) of each person
+    self.hid = AssignmentState.positions(p_data.HID.values, h_data.index)
+    # HRP (person position) of each household
+    self.hrp = AssignmentState.positions(h_data.HRPID.values, p_data.index)
+    self.filled = h_data.FILLED.values.astype(bool)
+    # carried forward households that weren't filled last year: closed to the structural passes, reopened (see unfill)
+    # for the surplus passes
+    self.reopen = np.zeros(len(self.h_ids), dtype=bool)
+
+    # running totals
+    self.n_people = len(self.hid)
+    self.n_assigned = int(np.sum(self.hid != -1))
+    self.n_occupied = int(np.sum(self.h_type > 0))
+    self.n_unoccupied = int(np.sum(self.h_type == -1))
+    self.n_filled = int(np.sum(self.filled))
+    self.n_occupied_unfilled = int(np.sum(~self.filled & (self.h_type > 0)))
+
+    # positions of the people in each MSOA and the households in each OA
+    self.p_by_area = p_data.groupby("Area", sort=False).indices
+    self.h_by_area = h_data.groupby("Area", sort=False).indices
+
+  @staticmethod
+  def positions(ids, index):
+    """
+    Returns the positions in index of ids (-1 for unassigned ids)
+    """
+    positions = np.full(len(ids), -1, dtype=int)
+    assigned = ids != -1
+    positions[assigned] = index.get_indexer(ids[assigned])
+    return positions
+
+  def people(self, msoa):
+    """
+    Returns the positions of the people in msoa
+    """
+    return self.p_by_area.get(msoa, np.array([], dtype=int))
+
+  def households(self, oas):
+    """
+    Returns the positions (in table order) of the households in oas
+    """
+    positions = [self.h_by_area[oa] for oa in oas if oa in self.h_by_area]
+    if not positions:
+      return np.array([], dtype=int)
+    return np.sort(np.concatenate(positions))
+
+  def assign(self, p_ref, h_ref):
+    """
+    Assigns people (positions) to households (positions, or a single position)
+    """
+    p_ref = np.asarray(p_ref, dtype=int)
+    self.n_assigned += int(np.sum(self.hid[p_ref] == -1))
+    self.hid[p_ref] = h_ref
+
+  def set_hrp(self, h_ref, p_ref):
+    """
+    Sets the HRPs (people positions) of households (positions). Doesn't assign the HRPs to the households
+    """
+    self.hrp[h_ref] = p_ref
+
+  def fill(self, h_ref):
+    """
+    Marks households (positions, or a single position) as filled
+    """
+    h_ref = np.atleast_1d(h_ref)
+    newly = np.unique(h_ref[~self.filled[h_ref]])
+    self.n_filled += len(newly)
+    self.n_occupied_unfilled -= int(np.sum(self.h_type[newly] > 0))
+    self.filled[newly] = True
+
+  def unfill(self, h_ref):
+    """
+    Marks households (positions) as not filled
+    """
+    h_ref = np.atleast_1d(h_ref)
+    newly = np.unique(h_ref[self.filled[h_ref]])
+    self.n_filled -= len(newly)
+    self.n_occupied_unfilled += int(np.sum(self.h_type[newly] > 0))
+    self.filled[newly] = False
+
+  def sync(self, p_data, h_data):
+    """
+    Writes the linkage back to the person and household tables as HID, HRPID and FILLED
+    """
+    p_data["HID"] = self.__ids(self.hid, self.h_ids)
+    h_data["HRPID"] = self.__ids(self.hrp, self.p_ids)
+    h_data["FILLED"] = self.filled
+
+  @staticmethod
+  def __ids(positions, ids):
+    result = np.full(len(positions), -1, dtype=ids.dtype)
+    assigned = positions >= 0
+    result[assigned] = ids[positions[assigned]]
+    return result
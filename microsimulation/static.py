@@ -1,6 +1,7 @@
 """
 Microsimulation by a sequence of microsynthesised populations
 """
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 #from random import randint
@@ -12,6 +13,27 @@ import ukpopulation.customsnppdata as customsnppdata
 import ukpopulation.myedata as myedata
 import microsimulation.utils as utils
 import microsimulation.common as common
+import microsimulation.contingency as contingency
+from microsimulation.marginals import AgeSexMarginals
+from microsimulation.trace import Trace
+
+class PopulationProjections:
+  """
+  The population estimate/projection apis (mid-year estimates, NPP and SNPP, or a custom SNPP variant). Load once and
+  pass to each SequentialMicrosynthesis to avoid reloading per region
+  """
+
+  def __init__(self, variant, is_custom=False, cache_dir="./cache"):
+    self.mye_api = myedata.MYEData(cache_dir)
+    self.npp_api = nppdata.NPPData(cache_dir)
+    if is_custom:
+      if variant not in customsnppdata.list_custom_projections(cache_dir):
+        raise ValueError("Requested custom SNPP %s is not in the cache directory (%s)" % (variant, cache_dir))
+      print("Using custom SNPP variant %s" % variant)
+      print("NOTE: assuming custom SNPP variant disables rescaling to national variant")
+      self.snpp_api = customsnppdata.CustomSNPPData(variant, cache_dir)
+    else:
+      self.snpp_api = snppdata.SNPPData(cache_dir)
 
 class SequentialMicrosynthesis(common.Base):
   """
@@ -21,40 +43,51 @@ class SequentialMicrosynthesis(common.Base):
   based microsimulation
   """
 
-  def __init__(self, region, resolution, variant, is_custom=False, cache_dir="./cache", output_dir="./data", fast_mode=False):
+  def __init__(self, region, resolution, variant, is_custom=False, cache_dir="./cache", output_dir="./data", fast_mode=False,
+               trace=False, output_format="csv", marginals=None, projections=None, census_store=None):
+
+    # timing spans, written to trace_ssm_<region>_<resolution>_<variant>.json when enabled
+    self.trace = Trace(trace)
 
-    common.Base.__init__(self, region, resolution, cache_dir)
+    common.Base.__init__(self, region, resolution, cache_dir, census_store)
 
     self.output_dir = output_dir
     self.fast_mode = fast_mode
     self.variant = variant
     self.is_custom = is_custom
 
-    # init the population (projections) modules
-    self.mye_api = myedata.MYEData(cache_dir)
-    self.npp_api = nppdata.NPPData(cache_dir)
-    if self.is_custom:
-      if variant not in customsnppdata.list_custom_projections(cache_dir):
-        raise ValueError("Requested custom SNPP %s is not in the cache directory (%s)" % (variant, cache_dir))
-      print("Using custom SNPP variant %s" % variant)
-      print("NOTE: assuming custom SNPP variant disables rescaling to national variant")
-      self.snpp_api = customsnppdata.CustomSNPPData(variant, cache_dir)
-    else:
-      self.snpp_api = snppdata.SNPPData(cache_dir)
+    # init the population (projections) modules, unless shared
+    if projections is None:
+      projections = PopulationProjections(variant, is_custom, cache_dir)
+    self.mye_api = projections.mye_api
+    self.npp_api = projections.npp_api
+    self.snpp_api = projections.snpp_api
+
+    # age-sex marginals (shared, see AgeSexMarginals), filled for this region in run
+    self.marginals = marginals if marginals is not None \
+                     else AgeSexMarginals(variant, is_custom, cache_dir, self.mye_api, self.npp_api, self.snpp_api)
 
     # validation
     if not is_custom and self.variant not in nppdata.NPPData.VARIANTS:
       raise ValueError(self.variant + " is not a known projection variant")
     if not isinstance(self.fast_mode, bool):
       raise ValueError("fast mode should be boolean")
+    # csv (a row per person) or counts (a contingency table per year, see contingency.write)
+    if output_format not in ["csv", "counts"]:
+      raise ValueError("invalid output format {}".format(output_format))
+    self.output_format = output_format
 
     # TODO enable 2001 ref year?
     # (down)load the census 2011 tables
-    self.__get_census_data()
+    with self.trace.span("census"):
+      self.__get_census_data()
 
-  def run(self, ref_year, target_year):
+  def run(self, ref_year, target_year, pipelined=False):
     """
     Run the sequence
+    If pipelined, while each year is synthesised the age-sex marginal for the next year is prepared, and the output of
+    the previous year written, in background threads. Only the synthesis depends on the previous year (via the seed)
+    so the output is identical
     """
 
     # TODO enable 2001 ref year?
@@ -72,55 +105,104 @@ class SequentialMicrosynthesis(common.Base):
       print("Running in fast mode. Rounded IPF populations may not exactly match the marginals")
 
     print("Starting microsynthesis sequence...")
-    for year in utils.year_sequence(ref_year, target_year):
-      out_file = self.output_dir + "/ssm_" + self.region + "_" + self.resolution + "_" + self.variant + "_" + str(year) + ".csv"
-      # this is inconsistent with the household microsynth (batch script checks whether output exists)
-      # TODO make them consistent?
-      # With dynamic update of seed for now just recompute even if file exists
-      #if not os.path.isfile(out_file):
-
-      if year < self.snpp_api.min_year(self.region):
-        source = " [MYE]"
-      elif year <= self.snpp_api.max_year(self.region):  
-        source = " [SNPP]"
+    with self.trace.span("run", region=self.region, resolution=self.resolution, variant=self.variant,
+                         pipelined=pipelined):
+      years = utils.year_sequence(ref_year, target_year)
+      with self.trace.span("age_sex_cube"):
+        self.marginals.cover([self.region], years)
+      if pipelined:
+        self.__run_pipelined(years)
       else:
-        source = " [XNPP]"
-      print("Generating ", out_file, source, "... ",
-            sep="", end="", flush=True)
-      msynth = self.__microsynthesise(year)
-      print("OK")
+        for year in years:
+          with self.trace.span("year", year=year):
+            with self.trace.span("age_sex"):
+              marginal = self.__age_sex_marginal(year)
+            out_file, msynth = self.__run_year(year, marginal)
+            with self.trace.span("write"):
+              self.__write(out_file, msynth)
+    self.trace.write(self.output_dir + "/trace_ssm_" + self.region + "_" + self.resolution + "_" + self.variant + ".json")
+
+  def __run_pipelined(self, years):
+    # the background work isn't traced (spans aren't thread safe): the age_sex and write spans are the time spent waiting
+    # for it. Each pool has a single thread so the api calls, and the writes, are in sequence
+    with ThreadPoolExecutor(1) as marginals, ThreadPoolExecutor(1) as writer:
+      marginal = marginals.submit(self.__age_sex_marginal, years[0])
+      written = None
+      for i, year in enumerate(years):
+        with self.trace.span("year", year=year):
+          with self.trace.span("age_sex"):
+            current = marginal.result()
+          if i + 1 < len(years):
+            marginal = marginals.submit(self.__age_sex_marginal, years[i + 1])
+          out_file, msynth = self.__run_year(year, current)
+          with self.trace.span("write"):
+            # at most one year's output pending, and any error writing it is raised here
+            if written is not None:
+              written.result()
+            written = writer.submit(self.__write, out_file, msynth)
+      written.result()
+
+  def __run_year(self, year, marginal):
+    """
+    Synthesises the population for year given its age-sex marginal and source (see __age_sex_marginal). Returns the
+    output filename and the population
+    """
+    out_file = self.output_dir + "/ssm_" + self.region + "_" + self.resolution + "_" + self.variant + "_" + str(year) \
+             + (".npz" if self.output_format == "counts" else ".csv")
+    # this is inconsistent with the household microsynth (batch script checks whether output exists)
+    # TODO make them consistent?
+    # With dynamic update of seed for now just recompute even if file exists
+    #if not os.path.isfile(out_file):
+
+    age_sex, source = marginal
+    print("Generating ", out_file, source, "... ",
+          sep="", end="", flush=True)
+    msynth = self.__microsynthesise(year, age_sex)
+    print("OK")
+    return out_file, msynth
+
+  def __write(self, out_file, msynth):
+    if self.output_format == "counts":
+      contingency.write(out_file, msynth, self.geog_map, self.eth_map)
+    else:
       msynth.to_csv(out_file, index_label="PID")
 
-  def __microsynthesise(self, year): #LAD=self.region
-
-    # Census/seed proportions for geography and ethnicity
-    oa_prop = self.seed.sum((1, 2, 3)) / self.seed.sum()
-    eth_prop = self.seed.sum((0, 1, 2)) / self.seed.sum()
-   
+  def __age_sex_marginal(self, year):
+    """
+    Returns the age-sex marginal for year (from the cube, see AgeSexMarginals) and (a label for) its source
+    Doesn't depend on the seed, so can be prepared ahead of the synthesis
+    """
     if year < self.snpp_api.min_year(self.region):
-      age_sex = utils.create_age_sex_marginal(utils.adjust_pp_age(self.mye_api.filter(self.region, year)), self.region)
-    elif year <= self.npp_api.max_year():
-      # Don't attempt to apply NPP variant if before the start of the NPP data, or it's a custom SNPP 
-      if year < self.npp_api.min_year() or self.is_custom:
-        age_sex = utils.create_age_sex_marginal(utils.adjust_pp_age(self.snpp_api.filter(self.region, year)), self.region)
-      else:
-        age_sex = utils.create_age_sex_marginal(utils.adjust_pp_age(self.snpp_api.create_variant(self.variant, self.npp_api, self.region, year)), self.region)
+      source = " [MYE]"
+    elif year <= self.snpp_api.max_year(self.region):  
+      source = " [SNPP]"
     else:
-      raise ValueError("Cannot microsimulate past NPP horizon year ({})", self.npp_api.max_year())
+      source = " [XNPP]"
+    return self.marginals.marginal(self.region, year), source
+
+  def __microsynthesise(self, year, age_sex): #LAD=self.region
+
+    with self.trace.span("marginals"):
+      # Census/seed proportions for geography and ethnicity
+      oa_prop = self.seed.sum((1, 2, 3)) / self.seed.sum()
+      eth_prop = self.seed.sum((0, 1, 2)) / self.seed.sum()
+
+      # convert proportions/probabilities to integer frequencies
+      oa = hl.prob2IntFreq(oa_prop, age_sex.sum())["freq"]
+      eth = hl.prob2IntFreq(eth_prop, age_sex.sum())["freq"]
 
-    # convert proportions/probabilities to integer frequencies
-    oa = hl.prob2IntFreq(oa_prop, age_sex.sum())["freq"]
-    eth = hl.prob2IntFreq(eth_prop, age_sex.sum())["freq"]
     # combine the above into a 2d marginal using QIS-I and census 2011 or later data as the seed
-    oa_eth = hl.qisi(self.seed.sum((1, 2)), [np.array([0]), np.array([1])], [oa, eth])
+    with self.trace.span("qisi_oa_eth"):
+      oa_eth = hl.qisi(self.seed.sum((1, 2)), [np.array([0]), np.array([1])], [oa, eth])
     if not (isinstance(oa_eth, dict) and oa_eth["conv"]):
       raise RuntimeError("oa_eth did not converge")
 
     # now the full seeded microsynthesis
-    if self.fast_mode:
-      msynth = hl.ipf(self.seed, [np.array([0, 3]), np.array([1, 2])], [oa_eth["result"].astype(float), age_sex.astype(float)])
-    else:
-      msynth = hl.qisi(self.seed, [np.array([0, 3]), np.array([1, 2])], [oa_eth["result"], age_sex])
+    with self.trace.span("ipf" if self.fast_mode else "qisi"):
+      if self.fast_mode:
+        msynth = hl.ipf(self.seed, [np.array([0, 3]), np.array([1, 2])], [oa_eth["result"].astype(float), age_sex.astype(float)])
+      else:
+        msynth = hl.qisi(self.seed, [np.array([0, 3]), np.array([1, 2])], [oa_eth["result"], age_sex])
     if not msynth["conv"]:
       print(msynth)
       raise RuntimeError("msynth did not converge")
@@ -132,46 +214,64 @@ class SequentialMicrosynthesis(common.Base):
     else:
       print("updating seed to", year, " ", end="")
       self.seed = msynth["result"].astype(float)
-    rawtable = hl.flatten(msynth["result"]) #, c("OA", "SEX", "AGE", "ETH"))
+    if self.output_format == "counts":
+      # no need to expand into individuals: the totals are the sums of the counts
+      table = msynth["result"]
+      totals = (table.sum((1, 2, 3)), table.sum((0, 1, 2)), table.sum((0, 3)))
+    else:
+      with self.trace.span("table"):
+        rawtable = hl.flatten(msynth["result"]) #, c("OA", "SEX", "AGE", "ETH"))
 
-    # col names and remapped values
-    table = pd.DataFrame(columns=["Area", "DC1117EW_C_SEX", "DC1117EW_C_AGE", "DC2101EW_C_ETHPUK11"])
-    table.Area = utils.remap(rawtable[0], self.geog_map)
-    table.DC1117EW_C_SEX = utils.remap(rawtable[1], [1, 2])
-    table.DC1117EW_C_AGE = utils.remap(rawtable[2], range(1, 87))
-    table.DC2101EW_C_ETHPUK11 = utils.remap(rawtable[3], self.eth_map)
+        # col names and remapped (categorical/small integer) values
+        table = pd.DataFrame({"Area": utils.decode(rawtable[0], self.geog_map),
+                              "DC1117EW_C_SEX": utils.decode(rawtable[1], [1, 2]),
+                              "DC1117EW_C_AGE": utils.decode(rawtable[2], range(1, 87)),
+                              "DC2101EW_C_ETHPUK11": utils.decode(rawtable[3], self.eth_map)})
+        totals = SequentialMicrosynthesis.__totals(rawtable, msynth["result"].shape)
 
     # consistency checks (in fast mode just report discrepancies)
-    self.__check(table, age_sex, oa_eth["result"])
+    with self.trace.span("check"):
+      self.__check(totals, age_sex, oa_eth["result"])
 
     return table
 
-  def __check(self, table, age_sex, oa_eth):
+  @staticmethod
+  def __totals(rawtable, shape):
+    """
+    Returns the area, ethnicity and sex-age totals of the (flattened, not yet remapped) population, each a single count
+    over the category indices in rawtable
+    """
+    sex_age = np.ravel_multi_index((rawtable[1], rawtable[2]), shape[1:3])
+    return (np.bincount(rawtable[0], minlength=shape[0]),
+            np.bincount(rawtable[3], minlength=shape[3]),
+            np.bincount(sex_age, minlength=shape[1] * shape[2]).reshape(shape[1:3]))
+
+  def __check(self, totals, age_sex, oa_eth):
+    """
+    Checks the area, ethnicity and age-sex totals of the population (see __totals) against the marginals
+    """
 
     failures = []
 
     # check area totals
     areas = oa_eth.sum(1)
-    for i in range(0, len(areas)):
-      if len(table[table.Area == self.geog_map[i]]) != areas[i]:
-        failures.append("Area " + self.geog_map[i] + " total mismatch: "
-                        + str(len(table[table.Area == self.geog_map[i]])) + " vs " + str(areas[i]))
+    counts = totals[0]
+    for i in np.flatnonzero(counts != areas):
+      failures.append("Area " + self.geog_map[i] + " total mismatch: "
+                      + str(counts[i]) + " vs " + str(areas[i]))
 
     # check ethnicity totals
     eths = oa_eth.sum(0)
-    for i in range(0, len(eths)):
-      if len(table[table.DC2101EW_C_ETHPUK11 == self.eth_map[i]]) != eths[i]:
-        failures.append("Ethnicity " + str(self.eth_map[i]) + " total mismatch: "
-                        + str(len(table[table.DC2101EW_C_ETHPUK11 == self.eth_map[i]])) + " vs " + str(eths[i]))
+    counts = totals[1]
+    for i in np.flatnonzero(counts != eths):
+      failures.append("Ethnicity " + str(self.eth_map[i]) + " total mismatch: "
+                      + str(counts[i]) + " vs " + str(eths[i]))
 
     # check gender and age totals
-    for sex in [0, 1]:
-      for age in range(0, 86):
-        #print( len(table[(table.DC1117EW_C_SEX == s+1) & (table.DC1117EW_C_AGE == a+1)]), age_sex[s,a])
-        if len(table[(table.DC1117EW_C_SEX == sex+1) & (table.DC1117EW_C_AGE == age+1)]) != age_sex[sex, age]:
-          failures.append("Age-gender " + str(age+1) + "/" + str(sex+1) + " total mismatch: "
-                          + str(len(table[(table.DC1117EW_C_SEX == sex+1) & (table.DC1117EW_C_AGE == age+1)]))
-                          + " vs " + str(age_sex[sex, age]))
+    counts = totals[2]
+    for sex, age in zip(*np.nonzero(counts != age_sex)):
+      failures.append("Age-gender " + str(age+1) + "/" + str(sex+1) + " total mismatch: "
+                      + str(counts[sex, age]) + " vs " + str(age_sex[sex, age]))
 
     if failures and not self.fast_mode:
       print("\n".join(failures))
@@ -7,6 +7,32 @@ import pandas as pd
 #import humanleague as hl
 import ukpopulation.snhpdata as SNHPData 
 import microsimulation.utils as Utils
+from microsimulation.trace import Trace
+
+class HouseholdProjections:
+  """
+  The subnational household projections, and the older projections used as a fallback (for England/Wales and for
+  Scotland). Load once and pass to each SequentialMicrosynthesisH to avoid reloading per region
+  """
+
+  def __init__(self, cache_dir, input_dir):
+    self.snhpdata = SNHPData.SNHPData(cache_dir)
+    self.input_dir = input_dir
+    # old way (needed for pre-2014/6 data for Wales/Scotland/NI), loaded only if a region needs it (see fallback)
+    self.snhp_fallback = None
+    self.snhp_fallback_sc = None
+
+  def fallback(self, scotland):
+    """
+    Returns the older projections for Scotland or for England/Wales, loading them on first use
+    """
+    if scotland:
+      if self.snhp_fallback_sc is None:
+        self.snhp_fallback_sc = pd.read_csv(self.input_dir + "/snhp2016_sc.csv", index_col="GEOGRAPHY_CODE")
+      return self.snhp_fallback_sc
+    if self.snhp_fallback is None:
+      self.snhp_fallback = pd.read_csv(self.input_dir + "/snhp2014.csv", index_col="AreaCode")
+    return self.snhp_fallback
 
 class SequentialMicrosynthesisH:
   """
@@ -18,7 +44,7 @@ class SequentialMicrosynthesisH:
 
   # Define the year that SNPP was based on (assumeds can then project to SNPP_YEAR+25)
   
-  def __init__(self, region, resolution, cache_dir, upstream_dir, input_dir, output_dir):
+  def __init__(self, region, resolution, cache_dir, upstream_dir, input_dir, output_dir, trace=False, projections=None):
 
     self.region = region
     self.resolution = resolution
@@ -26,20 +52,22 @@ class SequentialMicrosynthesisH:
     self.input_dir = input_dir
     self.output_dir = output_dir
 
+    # timing spans, written to trace_ssm_hh_<region>_<resolution>.json when enabled
+    self.trace = Trace(trace)
+
     self.scotland = False
     if self.region[0] == "S":
       self.scotland = True
 
-    # load the subnational household projections
-    self.snhpdata = SNHPData.SNHPData(cache_dir)
-    # old way (needed for pre-2014/6 data for Wales/Scotland/NI)
-    if not self.scotland:
-      self.snhp_fallback = pd.read_csv(self.input_dir + "/snhp2014.csv", index_col="AreaCode")
-    else:
-      self.snhp_fallback = pd.read_csv(self.input_dir + "/snhp2016_sc.csv", index_col="GEOGRAPHY_CODE")
+    # load the subnational household projections, unless shared
+    if projections is None:
+      projections = HouseholdProjections(cache_dir, input_dir)
+    self.snhpdata = projections.snhpdata
+    self.snhp_fallback = projections.fallback(self.scotland)
 
     # load the output from the microsynthesis (census 2011 based)
-    self.base_population = self.__get_base_populationdata()
+    with self.trace.span("load"):
+      self.base_population = self.__get_base_populationdata()
 
   def run(self, base_year, target_year):
     """
@@ -78,16 +106,23 @@ class SequentialMicrosynthesisH:
 
     population = self.base_population.copy()
 
-    for year in Utils.year_sequence(base_year, target_year):
-      out_file = self.output_dir + "/ssm_hh_" + self.region + "_" + self.resolution + "_" + str(year) + ".csv"
-      # this is inconsistent with the household microsynth (batch script checks whether output exists)
-      # TODO make them consistent?
-      # With dynamic update of seed for now just recompute even if file exists
-      print("Generating ", out_file, " [SNHP]", "... ",
-            sep="", end="", flush=True)
-      # workaround for pre-projection years
-      pop = int(self.__get_snhp(year) / occupancy_factor)
-
+    with self.trace.span("run", region=self.region, resolution=self.resolution):
+      for year in Utils.year_sequence(base_year, target_year):
+        with self.trace.span("year", year=year):
+          self.__run_year(year, population, occupancy_factor, dissolution_rate)
+    self.trace.write(self.output_dir + "/trace_ssm_hh_" + self.region + "_" + self.resolution + ".json")
+
+  def __run_year(self, year, population, occupancy_factor, dissolution_rate):
+    out_file = self.output_dir + "/ssm_hh_" + self.region + "_" + self.resolution + "_" + str(year) + ".csv"
+    # this is inconsistent with the household microsynth (batch script checks whether output exists)
+    # TODO make them consistent?
+    # With dynamic update of seed for now just recompute even if file exists
+    print("Generating ", out_file, " [SNHP]", "... ",
+          sep="", end="", flush=True)
+    # workaround for pre-projection years
+    pop = int(self.__get_snhp(year) / occupancy_factor)
+
+    with self.trace.span("sample"):
       # 1-dissolution_rate applied to existing population
       persisting = int(len(population) * (1.0 - dissolution_rate))
       sample = population.sample(n=persisting, replace=False)
@@ -95,12 +130,14 @@ class SequentialMicrosynthesisH:
       if pop > persisting:
         newlyformed = population.sample(n=pop-persisting, replace=False)
         sample = sample.append(newlyformed, ignore_index=True)
-      # append with ignore_index means steps below not necessary
-      # drop the old index column (which is no longer the index)
-      #sample = sample.reset_index().drop(columns=['HID']) # ,'index'
+    # append with ignore_index means steps below not necessary
+    # drop the old index column (which is no longer the index)
+    #sample = sample.reset_index().drop(columns=['HID']) # ,'index'
+    with self.trace.span("check"):
       self.__check(sample)
-      #msynth = self.__microsynthesise(year)
-      print("OK")
+    #msynth = self.__microsynthesise(year)
+    print("OK")
+    with self.trace.span("write"):
       sample.to_csv(out_file, index_label="HID")
 
   def __check(self, sample):
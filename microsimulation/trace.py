@@ -0,0 +1,63 @@
+"""
+Lightweight hierarchical timing of model stages
+"""
+
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+# returned by span when tracing is disabled
+_NO_SPAN = nullcontext()
+
+class Trace:
+  """
+  Records (nested) timing spans, e.g.
+    with trace.span("year", year=2012):
+      with trace.span("write"):
+        ...
+  When disabled, span does nothing, so it can be left in place at little cost. Spans are held as a tree of dicts with
+  name, start (epoch seconds), duration (seconds), any attributes and children, and can be written as json
+  """
+
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.spans = []
+    # children of the currently open spans
+    self.__open = [self.spans]
+
+  def span(self, name, **attrs):
+    """
+    Returns a context manager timing the enclosed block as a child of the current span
+    """
+    if not self.enabled:
+      return _NO_SPAN
+    return self.__span(name, attrs)
+
+  @contextmanager
+  def __span(self, name, attrs):
+    span = {"name": name, "start": time.time()}
+    span.update(attrs)
+    span["children"] = []
+    self.__open[-1].append(span)
+    self.__open.append(span["children"])
+    start = time.perf_counter()
+    try:
+      yield span
+    finally:
+      span["duration"] = time.perf_counter() - start
+      self.__open.pop()
+
+  def add(self, spans):
+    """
+    Adds spans recorded elsewhere (e.g. by a worker process) as children of the current span
+    """
+    if self.enabled:
+      self.__open[-1].extend(spans)
+
+  def write(self, filename):
+    """
+    Writes the spans to filename as json (if enabled)
+    """
+    if self.enabled:
+      with open(filename, "w") as f:
+        json.dump({"spans": self.spans}, f, indent=1)
@@ -64,15 +64,20 @@ def listify(array, valuename, colnames):
 # this is a copy-paste from household_microsynth
 def remap(indices, mapping):
   """
-  Converts array of index values back into category values
+  Converts array of index values back into category values (as a numpy array)
   """
-  # values = []
-  # for i in range(0, len(indices)):
-  #   values.append(mapping[indices[i]])
+  return np.take(np.asarray(mapping), indices)
 
-  values = [mapping[indices[i]] for i in range(len(indices))]
-
-  return values
+def decode(indices, mapping):
+  """
+  Converts array of index values into a compact column of category values: a pandas Categorical (from codes) for
+  non-numeric categories, otherwise the values in the smallest integer type that holds them
+  """
+  mapping = np.asarray(mapping)
+  if mapping.dtype.kind not in "iu":
+    return pd.Categorical.from_codes(indices, categories=mapping)
+  dtype = np.result_type(np.min_scalar_type(mapping.min()), np.min_scalar_type(mapping.max()))
+  return remap(indices, mapping.astype(dtype))
 
 def check_and_invert(columns, excluded):
   """
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+""" builds a local store of the census tables used by the static population microsimulation """
+
+import time
+import numpy as np
+import microsimulation.common as common
+from microsimulation.census import CensusStore
+from microsimulation.geography import GeogLookup
+import microsimulation.utils as utils
+
+DEFAULT_CACHE_DIR = "./cache"
+DEFAULT_INPUT_DIR = "./persistent_data"
+DEFAULT_CENSUS_DIR = "./census"
+
+def main(params):
+  """ Run it """
+
+  resolution = params["resolution"]
+  cache_dir = params.get("cache_dir", DEFAULT_CACHE_DIR)
+  input_dir = params.get("input_dir", DEFAULT_INPUT_DIR)
+  store = CensusStore(params.get("census_dir", DEFAULT_CENSUS_DIR))
+
+  regions = params["regions"]
+  # "all" means every LAD in GB
+  if regions == ["all"]:
+    lads = GeogLookup.load(input_dir + "/gb_geog_lookup").lad_codes.astype(str)
+    regions = [lad for lad in np.unique(lads) if lad[0] in "EWS"]
+
+  failures = []
+  for region in regions:
+    # already ingested (so can be rerun to complete a partial ingest)
+    if store.contains(region, resolution):
+      continue
+    try:
+      start_time = time.time()
+      print("Census tables:", region, "@", resolution)
+      store.write(region, resolution, common.Base(region, resolution, cache_dir).get_census_data())
+      print(region, "done. Exec time(s): ", time.time() - start_time)
+    except (RuntimeError, ValueError) as error:
+      print(region, "FAILED: ", error)
+      failures.append(region)
+  print("all done", "(failed: %s)" % " ".join(failures) if failures else "")
+
+if __name__ == "__main__":
+
+  PARAMS = utils.get_config()
+  main(PARAMS)
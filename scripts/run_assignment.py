@@ -23,26 +23,53 @@ def main(params):
   h_res = params["household_resolution"]
   p_res = params["person_resolution"]
   year = params["year"]
+  # optionally assign a range of years, each year reusing the previous year's linkage
+  end_year = params.get("end_year", year)
   variant = params["projection"]
   strict = params["strict"]
+  workers = params.get("workers", 1)
+  verbosity = params.get("verbosity", 1)
+  streaming = params.get("streaming", False)
+  output_format = params.get("output_format", "csv")
+  # write timing spans to trace_ass_*.json in the data directory
+  trace = params.get("trace", False)
+  # optionally (re)assign only these MSOAs
+  msoas = params.get("msoas")
+  # "pool" or "counts"
+  engine = params.get("engine", "pool")
+
+  # a range of years is assigned incrementally, which streaming mode doesn't support
+  if streaming and end_year != year:
+    raise ValueError("end_year cannot be used in streaming mode")
 
   print("Assignment region(s):", params["regions"])
   print("Assignment resolution: {} (H) / {} (P)".format(h_res, p_res)) 
   print("Projection:", variant)
   print("Strict assignment mode:", strict)
-  print("Assignment year:", year)
+  print("Assignment year(s):", year if end_year == year else "%d-%d" % (year, end_year))
+  print("Worker processes:", workers)
+  print("Streaming mode:", streaming)
+  print("Output format:", output_format)
+  print("Matching engine:", engine)
 
   data_dir = params["data_dir"] if "data_dir" in params else DEFAULT_DATA_DIR
 
+  # load the reference data (shared by all regions) once
+  reference = Assignment.ReferenceData()
+
   for region in params["regions"]:
-    # init assignment algorithm
-    #try:
-    # TODO variant / cfg json
-    ass = Assignment.Assignment(region, h_res, p_res, year, variant, strict, data_dir)
-    ass.run()
-    # except Exception as e:
-    #   print("ERROR:", e)
-    #   return
+    previous = None
+    for ass_year in utils.year_sequence(year, end_year):
+      # init assignment algorithm
+      #try:
+      # TODO variant / cfg json
+      ass = Assignment.Assignment(region, h_res, p_res, ass_year, variant, strict, data_dir, verbosity, reference,
+                                  streaming, output_format, trace, engine)
+      ass.run(workers, previous, msoas)
+      # except Exception as e:
+      #   print("ERROR:", e)
+      #   return
+      previous = ass
 
   print("Done. Exec time(s): ", time.time() - start_time)
 
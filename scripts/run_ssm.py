@@ -3,42 +3,112 @@
 """ run script for static sequential microsynthesis """
 
 import time
+import multiprocessing
 import microsimulation.static as Static
+from microsimulation.marginals import AgeSexMarginals
+from microsimulation.census import CensusStore
 import microsimulation.utils as utils
 
 #assert humanleague.version() > 1
 DEFAULT_CACHE_DIR = "./cache"
 DEFAULT_OUTPUT_DIR = "./data"
 
-def main(params):
-  """ Run it """
+# per-process settings and projection data, see _init_worker and _load
+_worker = {}
+
+def _init_worker(settings):
+  """ Sets the settings of the process (the projection data is loaded on first use, see _load) """
+  _worker["settings"] = settings
+
+def _load():
+  """ Loads the projection data (once per process). Not in _init_worker, as a pool respawns failed initialisers """
+  if "projections" in _worker:
+    return
+  settings = _worker["settings"]
+  _worker["census_store"] = CensusStore(settings["census_dir"]) if settings["census_dir"] else None
+  projections = Static.PopulationProjections(settings["variant"], settings["is_custom"], settings["cache_dir"])
+  _worker["marginals"] = AgeSexMarginals(settings["variant"], settings["is_custom"], settings["cache_dir"],
+                                         projections.mye_api, projections.npp_api, projections.snpp_api)
+  _worker["projections"] = projections
+
+def _run_region(region):
+  """ Runs a single region, returning the error if it failed """
+  settings = _worker["settings"]
+  try:
+    # start timing
+    start_time = time.time()
 
-  resolution = params["resolution"]
-  ref_year = params["census_ref_year"]
-  horizon_year = params["horizon_year"]
-  is_custom = params.get("custom_projection", False)
-  variant = params["projection"]
-  
-  cache_dir = params["cache_dir"] if "cache_dir" in params else DEFAULT_CACHE_DIR
-  output_dir = params["output_dir"] if "output_dir" in params else DEFAULT_OUTPUT_DIR
+    print("Static P Microsimulation: ", region, "@", settings["resolution"])
+    _load()
 
-  use_fast_mode = params["mode"] == "fast"
+    # init microsynthesis
+    ssm = Static.SequentialMicrosynthesis(region, settings["resolution"], settings["variant"], settings["is_custom"],
+                                          settings["cache_dir"], settings["output_dir"], settings["use_fast_mode"],
+                                          settings["trace"], settings["output_format"], _worker["marginals"],
+                                          _worker["projections"], _worker["census_store"])
+    ssm.run(settings["ref_year"], settings["horizon_year"], settings["pipelined"])
+
+    print(region, "done. Exec time(s): ", time.time() - start_time)
+  # any error (e.g. an unknown LAD, or loading the projections) fails only this region
+  except Exception as error:
+    print(region, "FAILED: ", error)
+    return region, str(error)
+  return region, None
+
+def _cover(regions, years, marginals=None):
+  """
+  Builds the age-sex marginals (by default this process's) for all the regions in one go, otherwise leaves each to be
+  built by its own run
+  """
+  try:
+    if marginals is None:
+      _load()
+      marginals = _worker["marginals"]
+    marginals.cover(regions, years)
+  except Exception as error:
+    print("FAILED to build age-sex marginals for all regions (%s), building per region" % error)
+
+def main(params):
+  """ Run it """
 
-  for region in params["regions"]:
-    try:
-      # start timing
-      start_time = time.time()
+  settings = {
+    "resolution": params["resolution"],
+    "ref_year": params["census_ref_year"],
+    "horizon_year": params["horizon_year"],
+    "is_custom": params.get("custom_projection", False),
+    "variant": params["projection"],
+    "cache_dir": params["cache_dir"] if "cache_dir" in params else DEFAULT_CACHE_DIR,
+    "output_dir": params["output_dir"] if "output_dir" in params else DEFAULT_OUTPUT_DIR,
+    "use_fast_mode": params["mode"] == "fast",
+    # write timing spans to trace_ssm_*.json in the output directory
+    "trace": params.get("trace", False),
+    # "csv" (a row per person) or "counts" (a contingency table per year)
+    "output_format": params.get("output_format", "csv"),
+    # prepare marginals and write output in the background
+    "pipelined": params.get("pipelined", False),
+    # local census store (see scripts/ingest_census.py), otherwise the census apis are used
+    "census_dir": params.get("census_dir")
+  }
+  # number of regions to run at once, each in its own process
+  workers = params.get("workers", 1)
 
-      print("Static P Microsimulation: ", region, "@", resolution)
+  # age-sex marginals for all the regions and years, built (or loaded from the cache) in one go
+  years = utils.year_sequence(settings["ref_year"], settings["horizon_year"])
 
-      # init microsynthesis
-      ssm = Static.SequentialMicrosynthesis(region, resolution, variant, is_custom, cache_dir, output_dir, use_fast_mode)
-      ssm.run(ref_year, horizon_year)
+  _init_worker(settings)
+  if workers > 1:
+    # the workers then load the marginals from the cache
+    _cover(params["regions"], years, AgeSexMarginals(settings["variant"], settings["is_custom"], settings["cache_dir"]))
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(settings,)) as pool:
+      results = list(pool.imap_unordered(_run_region, params["regions"]))
+  else:
+    _cover(params["regions"], years)
+    results = [_run_region(region) for region in params["regions"]]
 
-      print(region, "done. Exec time(s): ", time.time() - start_time)
-    except RuntimeError as error: 
-      print(region, "FAILED: ", error)
-  print("all done")
+  failures = [(region, error) for region, error in results if error is not None]
+  for region, error in failures:
+    print(region, "FAILED: ", error)
+  print("all done", "(%d of %d regions failed)" % (len(failures), len(results)) if failures else "")
 
 if __name__ == "__main__":
 
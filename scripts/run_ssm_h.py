@@ -3,6 +3,7 @@
 """ run script for static sequential microsynthesis """
 
 import time
+import multiprocessing
 import microsimulation.static_h as StaticH
 import microsimulation.utils as utils
 
@@ -11,35 +12,71 @@ DEFAULT_INPUT_DIR = "./persistent_data"
 DEFAULT_OUTPUT_DIR = "./data"
 DEFAULT_CACHE_DIR = "./cache"
 
+# per-process settings and projection data, see _init_worker and _load
+_worker = {}
+
+def _init_worker(settings):
+  """ Sets the settings of the process (the projection data is loaded on first use, see _load) """
+  _worker["settings"] = settings
+
+def _load():
+  """ Loads the projection data (once per process). Not in _init_worker, as a pool respawns failed initialisers """
+  if "projections" not in _worker:
+    settings = _worker["settings"]
+    _worker["projections"] = StaticH.HouseholdProjections(settings["cache_dir"], settings["input_dir"])
+
+def _run_region(region):
+  """ Runs a single region, returning the error if it failed """
+  settings = _worker["settings"]
+  try:
+    # start timing
+    start_time = time.time()
+
+    print("Static H Microsimulation ", region, "@", settings["resolution"])
+    _load()
+    # init microsynthesis
+    ssm = StaticH.SequentialMicrosynthesisH(region, settings["resolution"], settings["cache_dir"],
+                                            settings["upstream_dir"], settings["input_dir"], settings["output_dir"],
+                                            settings["trace"], _worker["projections"])
+    # generate the population
+    ssm.run(settings["ref_year"], settings["horizon_year"])
+
+    print("Done. Exec time(s): ", time.time() - start_time)
+  # any error (e.g. a missing projection file) fails only this region
+  except Exception as error:
+    print(region, "FAILED: ", error)
+    return region, str(error)
+  return region, None
+
 def main(params):
   """ Run it """
 
-  resolution = params["resolution"]
-  ref_year = params["census_ref_year"]
-  horizon_year = params["horizon_year"]
-  variant = params["projection"]
-
-  # upstream defaults to input  
-  upstream_dir = params["upstream_dir"] if "upstream_dir" in params else DEFAULT_INPUT_DIR
-  input_dir = params["input_dir"] if "input_dir" in params else DEFAULT_INPUT_DIR
-  output_dir = params["output_dir"] if "output_dir" in params else DEFAULT_OUTPUT_DIR
-  cache_dir = params["cache_dir"] if "cache_dir" in params else DEFAULT_CACHE_DIR
-
-  for region in params["regions"]:
-    try:
-      # start timing
-      start_time = time.time()
-
-      print("Static H Microsimulation ", region, "@", resolution)
-      # init microsynthesis
-      ssm = StaticH.SequentialMicrosynthesisH(region, resolution, cache_dir, upstream_dir, input_dir, output_dir)
-      # generate the population
-      ssm.run(ref_year, horizon_year)
-
-      print("Done. Exec time(s): ", time.time() - start_time)
-    except RuntimeError as error: 
-      print(region, "FAILED: ", error)  
-  print("All Done.")
+  settings = {
+    "resolution": params["resolution"],
+    "ref_year": params["census_ref_year"],
+    "horizon_year": params["horizon_year"],
+    # upstream defaults to input  
+    "upstream_dir": params["upstream_dir"] if "upstream_dir" in params else DEFAULT_INPUT_DIR,
+    "input_dir": params["input_dir"] if "input_dir" in params else DEFAULT_INPUT_DIR,
+    "output_dir": params["output_dir"] if "output_dir" in params else DEFAULT_OUTPUT_DIR,
+    "cache_dir": params["cache_dir"] if "cache_dir" in params else DEFAULT_CACHE_DIR,
+    # write timing spans to trace_ssm_hh_*.json in the output directory
+    "trace": params.get("trace", False)
+  }
+  # number of regions to run at once, each in its own process
+  workers = params.get("workers", 1)
+
+  _init_worker(settings)
+  if workers > 1:
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(settings,)) as pool:
+      results = list(pool.imap_unordered(_run_region, params["regions"]))
+  else:
+    results = [_run_region(region) for region in params["regions"]]
+
+  failures = [(region, error) for region, error in results if error is not None]
+  for region, error in failures:
+    print(region, "FAILED: ", error)
+  print("All Done.", "(%d of %d regions failed)" % (len(failures), len(results)) if failures else "")
 
 if __name__ == "__main__":
 
@@ -1,11 +1,28 @@
 """ 
 Test harness
 """
+import os
+import json
+import types
+import tempfile
 from unittest import TestCase
 
+import numpy as np
+import pandas as pd
+
 import microsimulation.static as Static
 import microsimulation.static_h as StaticH
 import microsimulation.assignment as Assignment
+import microsimulation.utils as utils
+from microsimulation.pool import PersonPool
+from microsimulation.sampler import ConditionalSampler
+from microsimulation.geography import GeogLookup
+from microsimulation.matching import CountMatcher
+import microsimulation.columnar as columnar
+import microsimulation.contingency as contingency
+from microsimulation.trace import Trace
+from microsimulation.census import CensusStore
+from microsimulation.marginals import AgeSexMarginals
 
 class Test(TestCase):
 
@@ -52,3 +69,292 @@ class Test(TestCase):
     assign.run()
     #self.assertTrue(False)
 
+  @staticmethod
+  def _assignment_input(rng):
+    """ Synthetic households and people (2011) for the first two MSOAs of E06000001 """
+    lookup = pd.read_csv("./persistent_data/gb_geog_lookup.csv.gz")
+    lookup = lookup[lookup.MSOA.isin(sorted(lookup[lookup.LAD == "E06000001"].MSOA.unique())[:2])]
+    # single adults and couples with children, 10 per OA
+    h_type = rng.choice([1, 3, 5], len(lookup) * 10)
+    h_data = pd.DataFrame({"Area": np.repeat(lookup.OA.values, 10), "LC4408_C_AHTHUK11": h_type,
+                           "LC4404_C_SIZHUK11": np.where(h_type == 1, 1, 4), "LC4202_C_ETHHUK11": 2,
+                           "QS420_CELL": -1, "CommunalSize": -1, "LC4402_C_TYPACCOM": 2})
+    h_data.index.name = "HID"
+    n = len(h_data) * 3
+    p_data = pd.DataFrame({"Area": rng.choice(lookup.MSOA.values, n), "DC1117EW_C_SEX": rng.randint(1, 3, n),
+                           "DC1117EW_C_AGE": np.where(rng.rand(n) < 0.3, rng.randint(1, 16, n), rng.randint(20, 80, n)),
+                           "DC2101EW_C_ETHPUK11": 2})
+    p_data.index.name = "PID"
+    return h_data, p_data
+
+  @staticmethod
+  def _assign(h_data, p_data, suffix="", **kwargs):
+    """ Assigns the input (for 2011) in a temporary directory, returning the output people, households and report """
+    with tempfile.TemporaryDirectory() as data_dir:
+      h_data.to_csv(os.path.join(data_dir, "ssm_hh_E06000001_OA11_2011.csv"))
+      p_data.to_csv(os.path.join(data_dir, "ssm_E06000001_MSOA11_ppp_2011.csv"))
+      workers = kwargs.pop("workers", 1)
+      msoas = kwargs.pop("msoas", None)
+      Assignment.Assignment("E06000001", "OA11", "MSOA11", 2011, "ppp", False, data_dir, **kwargs).run(workers, None, msoas)
+      p_out = pd.read_csv(os.path.join(data_dir, "ass_E06000001_MSOA11_2011%s.csv" % suffix), index_col="PID")
+      h_out = pd.read_csv(os.path.join(data_dir, "ass_hh_E06000001_OA11_2011%s.csv" % suffix), index_col="HID")
+      with open(os.path.join(data_dir, "ass_check_E06000001_2011%s.json" % suffix)) as f:
+        report = json.load(f)
+    return p_out.sort_index(), h_out.sort_index(), report
+
+  # incremental assignment (from the previous year) should be no worse than from scratch
+  def test_z_assign_incremental(self):
+    rng = np.random.RandomState(0)
+    h_data, p_data = Test._assignment_input(rng)
+    # a year on, the same households and people (aged by one) plus some babies
+    babies = p_data.sample(frac=0.1, random_state=rng).assign(DC1117EW_C_AGE=1)
+    p_data2 = pd.concat([p_data.assign(DC1117EW_C_AGE=p_data.DC1117EW_C_AGE + 1), babies], ignore_index=True)
+    p_data2.index.name = "PID"
+    with tempfile.TemporaryDirectory() as data_dir:
+      for year, people in [(2011, p_data), (2012, p_data2)]:
+        h_data.to_csv(os.path.join(data_dir, "ssm_hh_E06000001_OA11_%d.csv" % year))
+        people.to_csv(os.path.join(data_dir, "ssm_E06000001_MSOA11_ppp_%d.csv" % year))
+      reference = Assignment.ReferenceData()
+      previous = Assignment.Assignment("E06000001", "OA11", "MSOA11", 2011, "ppp", False, data_dir, reference=reference)
+      previous.run()
+      incremental = Assignment.Assignment("E06000001", "OA11", "MSOA11", 2012, "ppp", False, data_dir, reference=reference)
+      incremental.run(previous=previous)
+      fresh = Assignment.Assignment("E06000001", "OA11", "MSOA11", 2012, "ppp", False, data_dir, reference=reference)
+      fresh.run()
+    unassigned = [np.sum(a.p_data.HID.values == -1) for a in (incremental, fresh)]
+    self.assertLessEqual(unassigned[0], unassigned[1])
+    self.assertEqual(incremental.h_data.FILLED.sum(), fresh.h_data.FILLED.sum())
+
+  # streaming gives the same results as a full assignment (although the output rows are grouped by MSOA)
+  def test_z_assign_streaming(self):
+    h_data, p_data = Test._assignment_input(np.random.RandomState(1))
+    p_full, h_full, report_full = Test._assign(h_data, p_data)
+    p_stream, h_stream, report_stream = Test._assign(h_data, p_data, streaming=True)
+    self.assertTrue(p_stream.equals(p_full))
+    self.assertTrue(h_stream.equals(h_full))
+    self.assertEqual(report_stream, report_full)
+
+  # the results don't depend on the number of worker processes
+  def test_z_assign_workers(self):
+    h_data, p_data = Test._assignment_input(np.random.RandomState(2))
+    p_serial, h_serial, report_serial = Test._assign(h_data, p_data)
+    p_parallel, h_parallel, report_parallel = Test._assign(h_data, p_data, workers=2)
+    self.assertTrue(p_parallel.equals(p_serial))
+    self.assertTrue(h_parallel.equals(h_serial))
+    self.assertEqual(report_parallel, report_serial)
+
+  # communal establishments are filled in table order, so an earlier 16+ establishment can leave a 75+ one unfilled
+  def test_z_assign_communal(self):
+    lookup = GeogLookup.load("./persistent_data/gb_geog_lookup")
+    msoa = lookup.msoas_for_lad("E06000001")[0]
+    h_data = pd.DataFrame({"Area": lookup.oas_for_msoa(msoa)[0], "LC4408_C_AHTHUK11": -1, "LC4404_C_SIZHUK11": -1,
+                           "LC4202_C_ETHHUK11": -1, "QS420_CELL": [27, 2], "CommunalSize": [5, 1],
+                           "LC4402_C_TYPACCOM": -1})
+    h_data.index.name = "HID"
+    p_data = pd.DataFrame({"Area": [msoa] * 5, "DC1117EW_C_SEX": 1, "DC1117EW_C_AGE": 80,
+                           "DC2101EW_C_ETHPUK11": 2})
+    p_data.index.name = "PID"
+    p_out, h_out, _ = Test._assign(h_data, p_data)
+    self.assertEqual(list(h_out.FILLED), [True, False])
+    self.assertEqual(list(p_out.HID), [0] * 5)
+
+  # a subset of MSOAs assigned on their own is identical to the same MSOAs in a full assignment
+  def test_z_assign_subset(self):
+    h_data, p_data = Test._assignment_input(np.random.RandomState(3))
+    msoa = sorted(p_data.Area.unique())[1]
+    p_full, h_full, _ = Test._assign(h_data, p_data)
+    p_subset, h_subset, _ = Test._assign(h_data, p_data, "_subset", msoas=[msoa])
+    self.assertTrue(len(p_subset) and len(h_subset))
+    self.assertTrue(p_subset.equals(p_full[p_full.Area == msoa]))
+    oas = GeogLookup.load("./persistent_data/gb_geog_lookup").oas_for_msoa(msoa)
+    self.assertTrue(h_subset.equals(h_full[h_full.Area.isin(oas)]))
+
+
+  def test_person_pool(self):
+    pool = PersonPool("E02000001", [10, 11, 12], [30, 30, 5], [1, 1, 2], [2, 2, 2])
+    self.assertEqual(len(pool), 3)
+    # first unassigned match in table order
+    self.assertEqual(pool.take(30, 1, 2), [10])
+    pool.remove([11])
+    self.assertEqual(pool.take(30, 1, 2), [])
+    self.assertEqual(list(pool.unassigned()), [12])
+    self.assertEqual(list(pool.unassigned(pool.age > 16)), [])
+
+  def test_person_pool_nearest(self):
+    pool = PersonPool("E02000001", [10, 11, 12, 13, 14], [40, 20, 24, 36, 10], [1, 1, 1, 2, 1], [2, 3, 2, 2, 2])
+    # equidistant ages resolved by table order
+    self.assertEqual(pool.nearest(32, 1, 2, min_age=17), [10])
+    self.assertEqual(pool.nearest(32, 1, 3, min_age=17), [11])
+    self.assertEqual(pool.nearest(32, min_age=17), [13])
+    self.assertEqual(pool.nearest(32, 1, max_age=16), [14])
+    pool.remove([10, 12])
+    self.assertEqual(pool.nearest(32, 1, 2, min_age=17), [])
+    self.assertEqual(pool.nearest(32, 1, min_age=17), [11])
+
+  def test_count_matcher(self):
+    pool = PersonPool("E02000001", [10, 11, 12, 13, 14], [40, 20, 24, 36, 10], [1, 1, 1, 2, 1], [2, 3, 2, 2, 2])
+    # exact, then nearest age with same sex/eth, then same sex, then any; the last can't be matched
+    result = CountMatcher(pool, min_age=17).match([24, 30, 30, 30, 30], [1, 1, 1, 1, 1], [2, 2, 2, 2, 2])
+    self.assertEqual(list(result), [12, 10, 11, 13, -1])
+    self.assertEqual(list(pool.unassigned()), [14])
+    pool = PersonPool("E02000001", [10, 11], [5, 8], [1, 2], [2, 2])
+    # sex isn't relaxed
+    self.assertEqual(list(CountMatcher(pool, max_age=16, relax_sex=False).match([5, 5], [1, 1], [3, 3])), [10, -1])
+    # exact matches are at any age (as per the pool), only the relaxed levels are restricted
+    pool = PersonPool("E02000001", [10, 11, 12], [15, 20, 14], [1, 1, 1], [2, 2, 2])
+    self.assertEqual(list(CountMatcher(pool, min_age=17).match([15, 14], [1, 1], [2, 3])), [10, 11])
+
+  def test_feasibility(self):
+    h_data = pd.DataFrame({"LC4408_C_AHTHUK11": [1, 2, 4, 5, -1, -1], "LC4404_C_SIZHUK11": [1, 4, 3, 3, -1, -1],
+                           "QS420_CELL": [-1, -1, -1, -1, 2, 26], "CommunalSize": [-1, -1, -1, -1, 2, 3]})
+    demand = Assignment.Assignment.demand(h_data, ["E02000001"] * 5 + ["E02000002"]).set_index(["MSOA", "category"])
+    self.assertEqual(demand.loc[("E02000001", "adults"), "count"], 1 + 2 + 1 + 3 + 2)
+    self.assertEqual(demand.loc[("E02000001", "children"), "count"], 2 + 2)
+    self.assertEqual(demand.loc[("E02000001", "communal_75+"), "count"], 2)
+    self.assertEqual(demand.loc[("E02000002", "communal_18-25"), "count"], 3)
+    p_data = pd.DataFrame({"Area": ["E02000001"] * 3, "DC1117EW_C_AGE": [5, 17, 80]})
+    supply = Assignment.Assignment.supply(p_data).set_index(["MSOA", "category"])
+    self.assertEqual(list(supply["count"]), [2, 1, 1, 0])
+
+  def test_conditional_sampler(self):
+    dist = pd.DataFrame({"agehrp": [30, 30, 40], "ethhuk11": [2, 2, 3], "age": [28, 32, 41], "n": [1, 0, 5]})
+    sampler = ConditionalSampler(dist, [["agehrp", "ethhuk11"], ["agehrp"], []])
+    rows, levels = sampler.sample([[30, 2], [40, 2], [50, 2]])
+    # zero-weight row is never sampled
+    self.assertEqual(list(rows), [0, 2, rows[2]])
+    self.assertEqual(list(levels), [0, 1, 2])
+    rows, levels = sampler.sample([[40, 2]], max_level=0)
+    self.assertEqual(list(rows), [-1])
+    # draws from a given generator are reproducible
+    keys = [[30, 2], [50, 2], [50, 3]] * 10
+    rows1, _ = sampler.sample(keys, rng=np.random.default_rng(1))
+    rows2, _ = sampler.sample(keys, rng=np.random.default_rng(1))
+    self.assertEqual(list(rows1), list(rows2))
+
+  def test_decode(self):
+    self.assertEqual(list(utils.remap([1, 0, 1], [3, 5])), [5, 3, 5])
+    ages = utils.decode([0, 85], range(1, 87))
+    self.assertEqual(list(ages), [1, 86])
+    self.assertEqual(ages.dtype, np.uint8)
+    areas = utils.decode([1, 1, 0], ["E02000001", "E02000002"])
+    self.assertEqual(list(areas), ["E02000002", "E02000002", "E02000001"])
+    self.assertEqual(str(areas.dtype), "category")
+
+  def test_geog_lookup(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      csv_file = os.path.join(tmp_dir, "lookup.csv")
+      pd.DataFrame({"OA": ["E00000003", "E00000001", "E00000002", "E00000004"],
+                    "MSOA": ["E02000002", "E02000001", "E02000002", "E02000003"],
+                    "LAD": ["E09000002", "E09000001", "E09000002", "E09000001"]}).to_csv(csv_file, index=False)
+      lookup = GeogLookup.load(os.path.join(tmp_dir, "lookup"), csv_file)
+      # original order within MSOA is preserved
+      self.assertEqual(list(lookup.oas_for_msoa("E02000002")), ["E00000003", "E00000002"])
+      self.assertEqual(list(lookup.oas_for_msoa("E02000004")), [])
+      self.assertEqual(list(lookup.msoas_for_lad("E09000001")), ["E02000001", "E02000003"])
+      self.assertEqual(list(lookup.msoa_for_oa(["E00000004", "E00000009"])), ["E02000003", ""])
+      self.assertEqual(list(lookup.lad_for_msoa(["E02000002"])), ["E09000002"])
+      # codes that only match when truncated are unknown
+      self.assertEqual(list(lookup.oas_for_msoa("E02000002X")), [])
+      self.assertEqual(list(lookup.msoa_for_oa(["E00000004X", "E00000001"])), ["", "E02000001"])
+      # recompiled when the csv changes
+      pd.DataFrame({"OA": ["E00000001"], "MSOA": ["E02000009"], "LAD": ["E09000001"]}).to_csv(csv_file, index=False)
+      lookup = GeogLookup.load(os.path.join(tmp_dir, "lookup"), csv_file)
+      self.assertEqual(list(lookup.msoa_for_oa(["E00000001", "E00000004"])), ["E02000009", ""])
+
+  def test_columnar(self):
+    data = pd.DataFrame({"PID": [0, 1, 2], "Area": ["E02000001", "E02000002", "E02000001"],
+                         "DC1117EW_C_AGE": [1, 40, 86], "HID": [5, -1, 7]}).set_index("PID")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, "ass")
+      columnar.write(data, path, data.Area.values, 2011)
+      columnar.write(data, path, data.Area.values, 2012)
+      result = columnar.read(path, msoas=["E02000001"], years=[2012])
+      self.assertEqual(list(result.index), [0, 2])
+      self.assertEqual(list(result.HID), [5, 7])
+      self.assertEqual(str(result.DC1117EW_C_AGE.dtype), "int16")
+      self.assertEqual(len(columnar.read(path, columns=["HID"])), 6)
+
+  def test_contingency(self):
+    counts = np.zeros((2, 2, 86, 2), dtype=int)
+    counts[0, 0, 30, 1] = 2
+    counts[1, 1, 0, 0] = 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      filename = os.path.join(tmp_dir, "ssm.npz")
+      contingency.write(filename, counts, ["E02000001", "E02000002"], [2, 5])
+      self.assertEqual(contingency.cells(filename)["count"].tolist(), [2, 1])
+      people = list(contingency.expand(filename))
+      self.assertEqual(list(people[0].DC1117EW_C_AGE), [31, 31])
+      self.assertEqual(list(people[0].DC2101EW_C_ETHPUK11), [5, 5])
+      # PIDs as per the full population
+      area2 = next(contingency.expand(filename, areas=["E02000002"]))
+      self.assertEqual(list(area2.index), [2])
+      self.assertEqual(list(area2.DC1117EW_C_SEX), [2])
+
+  def test_census_store(self):
+    dc1117 = pd.DataFrame({"GEOGRAPHY_CODE": ["E02000002", "E02000001"], "C_SEX": [1, 2], "C_AGE": [1, 86],
+                           "OBS_VALUE": [3, 4]})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      store = CensusStore(tmp_dir)
+      self.assertFalse(store.contains("E09000001", "MSOA11"))
+      store.write("E09000001", "MSOA11", (dc1117, dc1117, None))
+      self.assertTrue(store.contains("E09000001", "MSOA11"))
+      tables = store.read("E09000001", "MSOA11")
+      # row order (and so area order) is preserved
+      self.assertTrue(tables[0].equals(dc1117))
+      self.assertIsNone(tables[2])
+
+  def test_age_sex_marginals(self):
+    lads = ["E06000001", "W06000001"]
+    def projection(codes, years):
+      index = pd.MultiIndex.from_product([np.atleast_1d(codes), np.atleast_1d(years), [1, 2], range(91)],
+                                         names=["GEOGRAPHY_CODE", "PROJECTED_YEAR_NAME", "GENDER", "C_AGE"])
+      data = index.to_frame(index=False)
+      data["OBS_VALUE"] = data.C_AGE * 1.37 + data.GENDER * 0.51 + (data.PROJECTED_YEAR_NAME - 2000) * 2.13 \
+                          + (data.GEOGRAPHY_CODE.str[0] == "W") * 10.0
+      return data
+    # mid-year estimates before 2014 (England) or 2015 (Wales), then SNPP, with the variant from 2016
+    mye_api = types.SimpleNamespace(filter=projection)
+    npp_api = types.SimpleNamespace(min_year=lambda: 2016)
+    snpp_api = types.SimpleNamespace(min_year=lambda lad: 2014 if lad[0] == "E" else 2015, filter=projection,
+                                     create_variant=lambda variant, npp, codes, years: projection(codes, years))
+    years = [2013, 2014, 2015, 2017]
+    with tempfile.TemporaryDirectory() as cache_dir:
+      marginals = AgeSexMarginals("ppp", False, cache_dir, mye_api, npp_api, snpp_api)
+      marginals.cover(lads, years)
+      # as per the per-year adjust_pp_age and create_age_sex_marginal
+      for lad in lads:
+        for year in years:
+          if year < snpp_api.min_year(lad):
+            source = mye_api.filter(lad, year)
+          elif year < npp_api.min_year():
+            source = snpp_api.filter(lad, year)
+          else:
+            source = snpp_api.create_variant("ppp", npp_api, lad, year)
+          expected = utils.create_age_sex_marginal(utils.adjust_pp_age(source), lad)
+          self.assertTrue(np.array_equal(marginals.marginal(lad, year), expected))
+      # loaded from the cache (without building)
+      cached = AgeSexMarginals("ppp", False, cache_dir)
+      cached.cover(lads, years)
+      self.assertTrue(np.array_equal(cached.marginal(lads[-1], years[-1]), expected))
+      # a year with no data is an error, and isn't cached
+      marginals.mye_api = types.SimpleNamespace(filter=lambda codes, years: projection(codes, []))
+      self.assertRaises(ValueError, marginals.cover, lads, [2012])
+      cached = AgeSexMarginals("ppp", False, cache_dir)
+      cached.cover(lads, years)
+      self.assertRaises(ValueError, cached.marginal, lads[0], 2012)
+
+  def test_trace(self):
+    trace = Trace(True)
+    with trace.span("run", year=2011):
+      with trace.span("a"):
+        pass
+      trace.add([{"name": "b", "start": 0.0, "duration": 1.0, "children": []}])
+    self.assertEqual([span["name"] for span in trace.spans], ["run"])
+    self.assertEqual(trace.spans[0]["year"], 2011)
+    self.assertEqual([span["name"] for span in trace.spans[0]["children"]], ["a", "b"])
+    self.assertGreaterEqual(trace.spans[0]["duration"], trace.spans[0]["children"][0]["duration"])
+    # disabled, records nothing
+    trace = Trace()
+    with trace.span("run"):
+      pass
+    self.assertEqual(trace.spans, [])